@@ -0,0 +1,251 @@
+"""Benchmarks for the hot paths in main.py.
+
+Those that need one run against a real MongoDB, configured the same way as
+the server:
+
+    MONGO_HOST=localhost python bench.py [name ...]
+
+Synthetic accounts are written to their own database (MONGO_DATABASE, by
+default "flashcards_bench"), which is dropped afterwards. With no names, every
+benchmark runs.
+"""
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('MONGO_DATABASE', 'flashcards_bench')
+
+import main  # noqa: E402
+
+import rsa  # noqa: E402
+from jose import jwk, jwt  # noqa: E402
+
+BENCHMARKS = {}
+_used_database = False
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timed(f, repeat=5):
+    """Median wall time of `f()` in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        f()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def scratch_database():
+    """Check the database is one this may fill and then drop."""
+    global _used_database
+    if main.flashcards_collection is None:
+        sys.exit('Database not connected')
+    # The database is dropped at the end; never let that be a real one.
+    if not main.db.name.endswith('_bench'):
+        sys.exit(f'MONGO_DATABASE is {main.db.name!r}; it must end in "_bench".')
+    _used_database = True
+
+
+def synthetic_decks(card_count, deck_count=10):
+    """Decks of studied and unstudied cards, shaped like real ones."""
+    decks = {f'Deck {n}': {} for n in range(deck_count)}
+    names = list(decks)
+    for n in range(card_count):
+        card = main._default_card(f'definition of term {n}, long enough to be realistic')
+        card['created_by'] = 'bench@example.com'
+        card['created_at'] = '2026-01-01T00:00:00'
+        if random.random() < 0.6:
+            card['seen'] = random.randint(1, 9)
+            card['correct'] = random.randint(0, card['seen'])
+            card['incorrect'] = card['seen'] - card['correct']
+            card['needs_review'] = random.random() < 0.3
+            card['last_reviewed'] = f'2026-0{random.randint(1, 9)}-1{random.randint(0, 9)}T12:00:00'
+        decks[names[n % deck_count]][f'term {n}'] = card
+    return decks
+
+
+@benchmark
+def stats():
+    """Per-deck counts for the deck list: counted in Python from the whole
+    document, counted by the aggregation pipeline, and read from summaries."""
+    scratch_database()
+    print(f"{'cards':>8} {'python':>10} {'pipeline':>10} {'summaries':>10}")
+    for card_count in (1_000, 10_000, 50_000):
+        email = f'stats-{card_count}@example.com'
+        decks = synthetic_decks(card_count)
+        main._insert_user(email, 'Deck 0', decks)
+        names = list(decks)
+
+        def in_python():
+            user_doc = main._load_user(email)
+            return {name: main._summary_of(cards)
+                    for name, cards in main.migrate_user_to_collections(user_doc).items()}
+
+        def in_pipeline():
+            return main._count_decks(main._load_user_outline(email), names)
+
+        def from_summaries():
+            return main._deck_summaries(main._load_user_outline(email), names)
+
+        assert in_python() == in_pipeline() == from_summaries()
+        print(f'{card_count:>8} {timed(in_python):>8.1f}ms {timed(in_pipeline):>8.1f}ms '
+              f'{timed(from_summaries):>8.1f}ms')
+
+
+@benchmark
+def cards_page():
+    """GET /api/cards on a 5,000-card deck: the whole deck, one page of it,
+    only terms and definitions, and a page of those -- time and size, with the
+    cards kept in the document and in the cards collection."""
+    scratch_database()
+    client = main.app.test_client()
+    requests = (('whole deck', ''), ('limit=200', '&limit=200'),
+                ('term,definition', '&fields=term,definition'),
+                ('both', '&limit=200&fields=term,definition'))
+    print(f"{'store':>10} {'request':>16} {'time':>10} {'size':>10}")
+    for store in ('document', main.CARD_STORE_COLLECTION):
+        main.CARD_STORE = store
+        email = f'cards-page-{store}@example.com'
+        main._insert_user(email, 'Deck 0', synthetic_decks(5_000, deck_count=1))
+        for label, query in requests:
+            url = f'/api/cards?email={email}&collection=Deck 0{query}'
+            size = len(client.get(url).data)
+            print(f'{store:>10} {label:>16} {timed(lambda: client.get(url)):>8.1f}ms '
+                  f'{size / 1024:>8.0f}KB')
+
+
+@benchmark
+def json_encoders():
+    """Encoding GET /api/cards' response for decks of 100 to 10,000 cards with
+    each of the JSON encoders, and the whole request made with each."""
+    scratch_database()
+    client = main.app.test_client()
+    encoders = list(main.JSON_ENCODERS)
+    print(f"{'cards':>8} {'size':>8} " + ' '.join(f'{name:>10} {"request":>10}' for name in encoders))
+    for card_count in (100, 1_000, 10_000):
+        email = f'json-{card_count}@example.com'
+        main._insert_user(email, 'Deck 0', synthetic_decks(card_count, deck_count=1))
+        url = f'/api/cards?email={email}&collection=Deck 0'
+        body = client.get(url).get_json()
+        row = f'{card_count:>8} {len(main._json_dumps(body)) / 1024:>6.0f}KB'
+        default = main._json_dumps
+        for encode in main.JSON_ENCODERS.values():
+            main._json_dumps = encode
+            row += f' {timed(lambda: encode(body), repeat=20):>8.2f}ms {timed(lambda: client.get(url)):>8.1f}ms'
+        main._json_dumps = default
+        print(row)
+
+
+def _proc_status(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def peak_rss(f):
+    """Peak resident memory while `f()` runs, above what was resident before,
+    in MB. Resets and reads the high-water mark Linux keeps for the process."""
+    with open('/proc/self/clear_refs', 'w') as refs:
+        refs.write('5')
+    before = _proc_status('VmRSS')
+    f()
+    return (_proc_status('VmHWM') - before) / 1024
+
+
+def read_response(client, url, headers=None):
+    """Time to the first byte in milliseconds, and the size, of a response
+    read a chunk at a time."""
+    started = time.perf_counter()
+    response = client.get(url, headers=headers, buffered=False)
+    first_byte, size = None, 0
+    for chunk in response.response:
+        if first_byte is None:
+            first_byte = (time.perf_counter() - started) * 1000
+        size += len(chunk)
+    response.close()
+    return first_byte, size
+
+
+@benchmark
+def streaming():
+    """Peak memory and time to first byte of the card listings for a
+    50,000-card deck, built whole, streamed as JSON and streamed as NDJSON,
+    with the cards kept in the document and in the cards collection."""
+    scratch_database()
+    client = main.app.test_client()
+    modes = (('whole', '', None), ('stream', '&stream=1', None),
+             ('ndjson', '', {'Accept': main.NDJSON_MIMETYPE}))
+    print(f"{'store':>10} {'endpoint':>10} {'mode':>8} {'peak RSS':>10} {'first byte':>11} {'size':>8}")
+    for store in ('document', main.CARD_STORE_COLLECTION):
+        main.CARD_STORE = store
+        email = f'streaming-{store}@example.com'
+        main._insert_user(email, 'Deck 0', synthetic_decks(50_000, deck_count=1))
+        share_id = client.post('/api/collections/Deck 0/share', json={'token': email}).get_json()['share_id']
+        endpoints = (('cards', f'/api/cards?email={email}&collection=Deck 0'),
+                     ('share', f'/api/shares/{share_id}?x=1'),
+                     ('words', f'/api/words?email={email}'))
+        for endpoint, url in endpoints:
+            for mode, query, headers in modes:
+                # Once to warm the caches, so only the request itself is measured.
+                read_response(client, url + query, headers)
+                result = []
+                peak = peak_rss(lambda: result.append(read_response(client, url + query, headers)))
+                first_byte, size = result[0]
+                print(f'{store:>10} {endpoint:>10} {mode:>8} {peak:>8.1f}MB {first_byte:>9.0f}ms '
+                      f'{size / 1024 / 1024:>6.1f}MB')
+
+
+def signed_token(private_key, kid, lifetime=3600):
+    now = int(time.time())
+    claims = {'sub': 'auth0|bench', 'aud': main.API_AUDIENCE,
+              'iss': f'https://{main.AUTH0_DOMAIN}/', 'iat': now, 'exp': now + lifetime}
+    return jwt.encode(claims, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+@benchmark
+def auth():
+    """Time spent authenticating one request, with every token verified from
+    scratch and with verified tokens cached."""
+    public_key, private_key = rsa.newkeys(2048)
+    pem = private_key.save_pkcs1().decode()
+    published = jwk.construct(pem, 'RS256').public_key().to_dict()
+    published.update(kid='bench', use='sig')
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as keys:
+        json.dump({'keys': [published]}, keys)
+    main.JWKS_FILE = keys.name
+    token = signed_token(pem, 'bench')
+
+    def authenticate():
+        main._verify_token(token)
+
+    def uncached():
+        main._verified_tokens.clear()
+        authenticate()
+
+    requests = 200
+    print(f"{'':>10} {'per request':>12}")
+    for label, f in (('uncached', uncached), ('cached', authenticate)):
+        authenticate()
+        total = timed(lambda: [f() for _ in range(requests)], repeat=3)
+        print(f'{label:>10} {total * 1000 / requests:>10.0f}us')
+    os.unlink(keys.name)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    try:
+        for name in sys.argv[1:] or BENCHMARKS:
+            print(f'== {name}')
+            BENCHMARKS[name]()
+    finally:
+        if _used_database:
+            main.client.drop_database(main.db.name)
@@ -1,17 +1,29 @@
 import os
 import json
-from flask import Flask, Response, request, jsonify
+import base64
+from flask import Flask, Response, g, has_request_context, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.exceptions import HTTPException
+import bson
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 import gridfs
-from datetime import datetime
+import click
+from datetime import datetime, timedelta
 import random
+import time
+import re
 import secrets
+import hashlib
+import math
+import threading
+import zlib
 from flask_cors import cross_origin
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 from functools import wraps
-from six.moves.urllib.request import urlopen
+from collections import OrderedDict, deque
+from six.moves.urllib.request import Request, urlopen
 from jose import jwt
 
 app = Flask(__name__)
@@ -40,12 +52,27 @@ try:
     images = gridfs.GridFS(db)
     # One document per shared collection; see the sharing section below.
     shares_collection = db.shares
+    # One document per card, for accounts whose cards have moved out of their
+    # user document; see "Card storage" below.
+    cards_collection = db.cards
+    # Progress of maintenance commands, so an interrupted run can resume.
+    checkpoints_collection = db.checkpoints
+    # State shared between server processes, such as Auth0's signing keys.
+    shared_state_collection = db.shared_state
     print(f"Connected to MongoDB at {mongo_host}:{mongo_port}")
 except Exception as e:
     print(f"Error connecting to MongoDB: {e}")
     flashcards_collection = None
     images = None
     shares_collection = None
+    cards_collection = None
+    checkpoints_collection = None
+    shared_state_collection = None
+
+# Where new accounts keep their cards: "document" (inside the user document)
+# or "collection" (one document each in the cards collection). Existing
+# accounts are moved with `flask --app main migrate-card-store`.
+CARD_STORE = os.environ.get('CARD_STORE', 'document')
 
 AUTH0_DOMAIN = 'dev-43bumhcy.us.auth0.com'
 API_AUDIENCE = 'recallcards'
@@ -121,6 +148,864 @@ def _legacy_value(card):
     return card["definition"] + (REVIEW_KEY if card["needs_review"] else "")
 
 
+# Stored names
+#
+# Deck and term names are whatever people type, and they end up as keys in the
+# user document. MongoDB reads a dot in an update key as a path separator and a
+# leading $ as an operator, so a name like "e.g." or "U.S.A." could not be
+# addressed by a field path. Names are therefore stored escaped -- `%` as %25,
+# `.` as %2E and `$` as %24, escaping `%` itself so the encoding reverses
+# exactly -- and decoded when a document is loaded. Nothing past _load_user()
+# ever sees an escaped name.
+#
+# Documents written before this carry raw names. `escaped_keys` marks the ones
+# that have been converted; _load_user() converts the rest the first time they
+# are read.
+
+_KEY_ESCAPES = {'%': '%25', '.': '%2E', '$': '%24'}
+_KEY_UNESCAPES = {escaped[1:]: char for char, escaped in _KEY_ESCAPES.items()}
+_ESCAPED_KEY_PATTERN = re.compile('%(25|2E|24)')
+
+
+def _escape_key(name):
+    """A deck or term name as it is stored."""
+    if '%' not in name and '.' not in name and '$' not in name:
+        return name
+    return ''.join(_KEY_ESCAPES.get(char, char) for char in name)
+
+
+def _unescape_key(key):
+    """The name a stored key stands for."""
+    if '%' not in key:
+        return key
+    return _ESCAPED_KEY_PATTERN.sub(lambda match: _KEY_UNESCAPES[match.group(1)], key)
+
+
+def _rekey(mapping, convert):
+    return {convert(key): value for key, value in mapping.items()}
+
+
+def _converted_maps(user_doc, convert):
+    """Every name-keyed map in a user document, with its names passed through
+    `convert`. Covers decks, the cards in them, per-deck settings along with
+    the tombstones of deleted cards, and followed decks along with the per-card
+    progress kept on each."""
+    maps = {}
+    if 'cards' in user_doc:
+        maps['cards'] = _rekey(user_doc['cards'], convert)
+    if 'collections' in user_doc:
+        maps['collections'] = {
+            convert(name): _rekey(cards, convert)
+            for name, cards in user_doc['collections'].items()
+        }
+    if 'collection_meta' in user_doc:
+        maps['collection_meta'] = {
+            convert(name): {**meta, 'deleted': _rekey(meta['deleted'], convert)} if 'deleted' in meta else meta
+            for name, meta in user_doc['collection_meta'].items()
+        }
+    if 'linked_collections' in user_doc:
+        maps['linked_collections'] = {
+            convert(name): {**link, 'progress': _rekey(link.get('progress') or {}, convert)}
+            for name, link in user_doc['linked_collections'].items()
+        }
+    return maps
+
+
+def _escape_stored_keys(user_doc):
+    """Convert a document written with raw names to escaped ones, in place in
+    the database. Only the maps that actually change are rewritten, and the
+    great majority of accounts have no name that needs escaping at all."""
+    escaped = _converted_maps(user_doc, _escape_key)
+    changed = {field: value for field, value in escaped.items() if value != user_doc[field]}
+    # Guarded on the marker, so two requests converting the same document at
+    # once cannot escape it twice.
+    _update_user(user_doc['user_email'], {'$set': {**changed, 'escaped_keys': True}},
+                 match={'_id': user_doc['_id'], 'escaped_keys': {'$ne': True}})
+
+
+def _load_user(email):
+    """The user document for an account with every name decoded, or None."""
+    entry, cached = _cached_user(email, 'whole')
+    if cached is not None:
+        return None if cached is _ABSENT else cached
+    user_doc = flashcards_collection.find_one({'user_email': email})
+    if user_doc is None:
+        _keep_absent(email, entry)
+        return None
+    if not user_doc.get('escaped_keys'):
+        # Raw names are already the real ones; only the stored copy changes.
+        _escape_stored_keys(user_doc)
+        user_doc['escaped_keys'] = True
+        return user_doc
+    user_doc.update(_converted_maps(user_doc, _unescape_key))
+    _keep_user(email, entry, 'whole', user_doc)
+    return user_doc
+
+
+# What every partial load brings along: enough to tell how the document is
+# stored and whether it is current.
+_DOCUMENT_STATE_FIELDS = ('user_email', 'escaped_keys', 'schema_version', 'card_store', 'revision')
+
+
+def _load_user_deck(email, collection_name):
+    """The user document for an account with only one deck in it, or None.
+
+    Brings that deck's cards, its settings and, if the account follows a deck
+    of that name, the follow record with its progress -- everything an
+    endpoint about a single deck reads -- so an account with dozens of decks
+    does not send all of them over the wire each time. A document that still
+    needs converting is loaded whole instead, since converting it rewrites maps
+    a partial load would only see part of.
+    """
+    if not collection_name:
+        # No deck has an empty name, and no projection can name one.
+        return _load_user(email)
+    kind = f'deck:{collection_name}'
+    entry, cached = _cached_user(email, 'whole', kind)
+    if cached is not None:
+        return None if cached is _ABSENT else cached
+    projection = {field: 1 for field in _DOCUMENT_STATE_FIELDS}
+    for path in (_collection_field_path(collection_name), _meta_field_path(collection_name),
+                 _link_field_path(collection_name)):
+        projection[path] = 1
+    user_doc = flashcards_collection.find_one({'user_email': email}, projection)
+    if user_doc is None:
+        _keep_absent(email, entry)
+        return None
+    decoded = _decoded_partial_user(user_doc)
+    if decoded is user_doc:
+        _keep_user(email, entry, kind, decoded)
+    return decoded
+
+
+def _decoded_partial_user(user_doc):
+    """A user document read with a projection, decoded like _load_user() does
+    -- or read again whole, if it still needs converting."""
+    if not user_doc.get('escaped_keys') or user_doc.get('schema_version') != SCHEMA_VERSION:
+        return _load_user(user_doc['user_email'])
+    for field in ('collections', 'collection_meta', 'linked_collections'):
+        user_doc.setdefault(field, {})
+    user_doc.update(_converted_maps(user_doc, _unescape_key))
+    return user_doc
+
+
+def _load_user_outline(email):
+    """The user document for an account with every deck in it but none of
+    their cards, or None.
+
+    For endpoints that go over every deck without needing what is in them.
+    Each deck is an empty placeholder, as for an account keeping its cards in
+    the cards collection, and the document is marked `outline` so that the
+    card readers below know to fetch what they are asked for. A document that
+    still needs converting is loaded whole.
+    """
+    entry, cached = _cached_user(email, 'whole', 'outline')
+    if cached is not None:
+        return None if cached is _ABSENT else cached
+    try:
+        found = list(flashcards_collection.aggregate([
+            {'$match': {'user_email': email}},
+            {'$limit': 1},
+            {'$addFields': {'collections': {'$arrayToObject': {'$map': {
+                'input': {'$objectToArray': {'$ifNull': ['$collections', {}]}},
+                'in': {'k': '$$this.k', 'v': {}},
+            }}}}},
+        ]))
+    except OperationFailure:
+        return _load_user(email)
+    if not found:
+        _keep_absent(email, entry)
+        return None
+    user_doc = found[0]
+    if not user_doc.get('escaped_keys') or user_doc.get('schema_version') != SCHEMA_VERSION:
+        return _load_user(email)
+    user_doc.update(_converted_maps(user_doc, _unescape_key))
+    user_doc['outline'] = True
+    _keep_user(email, entry, 'outline', user_doc)
+    return user_doc
+
+
+def _new_user_fields():
+    """Fields every new account document starts with."""
+    fields = {'escaped_keys': True, 'created_at': datetime.utcnow()}
+    if CARD_STORE == CARD_STORE_COLLECTION:
+        fields['card_store'] = CARD_STORE_COLLECTION
+    return fields
+
+
+def _insert_user(email, default_collection, collections=None, **fields):
+    """Create the document for an account that has none yet.
+
+    Returns False, having written nothing, if another request created one
+    first; the caller is then to make its change to that one instead.
+    """
+    changed = _now_ms()
+    collections = {name: {term: {**card, 'changed': changed} for term, card in cards.items()}
+                   for name, cards in (collections or {}).items()}
+    user_doc = {
+        'user_email': email,
+        'collections': collections,
+        'default_collection': default_collection,
+        'schema_version': SCHEMA_VERSION,
+        **_new_user_fields(),
+        **fields,
+    }
+    meta = user_doc.setdefault('collection_meta', {})
+    for name, cards in collections.items():
+        meta[name] = {**meta.get(name, {}), 'summary': _summary_of(cards),
+                      'sync_id': secrets.token_hex(6)}
+    documents = []
+    if _cards_in_collection(user_doc):
+        user_doc['collections'] = {name: {} for name in collections}
+        documents = [_card_document(email, name, term, card)
+                     for name, cards in collections.items() for term, card in cards.items()]
+    user_doc.update(_converted_maps(user_doc, _escape_key))
+    # The account first, so that losing the race to create it leaves no
+    # cards behind.
+    try:
+        flashcards_collection.insert_one(user_doc)
+    except DuplicateKeyError:
+        return False
+    finally:
+        _forget_user(email)
+    if documents:
+        cards_collection.insert_many(documents, ordered=False)
+    return True
+
+
+def _escaped_cards(cards):
+    return _rekey(cards, _escape_key)
+
+
+def _escaped_collections(collections):
+    return _converted_maps({'collections': collections}, _escape_key)['collections']
+
+
+# Card storage
+#
+# An account keeps its cards in one of two places. Originally every card of
+# every deck sat inside the user document, under collections.<deck>.<term>.
+# That caps an account at MongoDB's 16MB document limit and means reading one
+# deck loads all of them, so an account can instead keep one document per card
+# in the cards collection, keyed by (user_email, collection, term). Such an
+# account is marked `card_store: "collection"`, and its `collections` map
+# still lists every deck -- each as an empty placeholder -- so deck names,
+# their order and everything keyed by them stay where they always were.
+#
+# Only the functions in this section know which kind of account they are
+# looking at. Everything else asks for a deck or a card and gets the same
+# term -> card dicts either way.
+
+CARD_STORE_COLLECTION = 'collection'
+
+# A card document is the card's own fields plus the three that locate it.
+_CARD_DOCUMENT_PROJECTION = {'_id': 0, 'user_email': 0, 'collection': 0}
+
+
+def _cards_in_collection(user_doc):
+    return (user_doc or {}).get('card_store') == CARD_STORE_COLLECTION
+
+
+def _card_key(owner_email, collection_name, term):
+    return {'user_email': owner_email, 'collection': collection_name, 'term': term}
+
+
+def _card_document(owner_email, collection_name, term, card):
+    return {**_card_key(owner_email, collection_name, term), **card}
+
+
+def _deck_from_documents(documents):
+    # Insertion order, which is the order a deck kept in a document has.
+    return {doc.pop('term'): doc for doc in documents.sort('_id', 1)}
+
+
+def _owned_decks(user_doc):
+    """Every deck the account owns, with all of its cards."""
+    if user_doc.get('outline') and not _cards_in_collection(user_doc):
+        user_doc = _load_user(user_doc['user_email'])
+    collections = migrate_user_to_collections(user_doc)
+    if not _cards_in_collection(user_doc):
+        return {name: _current_deck(user_doc, name) for name in list(collections)}
+
+    decks = {name: {} for name in collections}
+    documents = cards_collection.find({'user_email': user_doc['user_email']},
+                                      {'_id': 0, 'user_email': 0})
+    for doc in documents.sort('_id', 1):
+        deck = decks.get(doc.pop('collection'))
+        if deck is not None:
+            deck[doc.pop('term')] = doc
+    return decks
+
+
+def _owned_deck(user_doc, collection_name):
+    """The cards of one deck the account owns, or None if it has no such deck."""
+    if not _cards_in_collection(user_doc):
+        if user_doc.get('outline') and collection_name in user_doc['collections']:
+            user_doc = _load_user_deck(user_doc['user_email'], collection_name)
+        return _current_deck(user_doc, collection_name)
+    if collection_name not in migrate_user_to_collections(user_doc):
+        return None
+    return _deck_from_documents(cards_collection.find(
+        {'user_email': user_doc['user_email'], 'collection': collection_name},
+        _CARD_DOCUMENT_PROJECTION,
+    ))
+
+
+def _owned_card(user_doc, collection_name, term):
+    """One card of a deck the account owns, or None."""
+    if not _cards_in_collection(user_doc):
+        return (_owned_deck(user_doc, collection_name) or {}).get(term)
+    doc = cards_collection.find_one(_card_key(user_doc['user_email'], collection_name, term),
+                                    _CARD_DOCUMENT_PROJECTION)
+    if doc is not None:
+        doc.pop('term')
+    return doc
+
+
+# Deck summaries
+#
+# The deck list shows, for every deck, how many cards it has and how far along
+# the reader is, and asks for it constantly. Counting that from the cards each
+# time is a pass over every card in the account, so each deck instead keeps
+# running totals in collection_meta.<deck>.summary, moved by the same write
+# that changes a card: $inc for the counts, $max for the latest review.
+#
+# A deck from before summaries were kept has none, or one holding only the
+# changes since. It is counted from its cards once, the first time it is asked
+# for, and the summary marked complete.
+
+_SUMMARY_COUNTS = ('total', 'studied', 'known', 'needs_review', 'correct', 'incorrect')
+
+
+def _summary_field_path(collection_name):
+    return f'{_meta_field_path(collection_name)}.summary'
+
+
+def _card_tally(card):
+    """What one card contributes to its deck's summary."""
+    if card is None:
+        return dict.fromkeys(_SUMMARY_COUNTS, 0)
+    card = _normalise_card(card)
+    studied = card['seen'] > 0
+    return {
+        'total': 1,
+        'studied': int(studied),
+        # "Known" means answered at least once and not currently flagged. A
+        # card you have never opened is neither known nor unknown.
+        'known': int(studied and not card['needs_review']),
+        'needs_review': int(bool(card['needs_review'])),
+        'correct': card['correct'],
+        'incorrect': card['incorrect'],
+    }
+
+
+def _summary_of(cards):
+    """A complete summary counted from a deck's cards."""
+    summary = dict.fromkeys(_SUMMARY_COUNTS, 0)
+    stamps = []
+    for value in cards.values():
+        for field, count in _card_tally(value).items():
+            summary[field] += count
+        if isinstance(value, dict) and value.get('last_reviewed'):
+            stamps.append(value['last_reviewed'])
+    if stamps:
+        # Left out rather than None, for $max to compare against.
+        summary['last_reviewed'] = max(stamps)
+    summary['complete'] = True
+    return summary
+
+
+def _summary_changes(collection_name, previous, card):
+    """The update operators that move a deck's summary from a card being
+    `previous` to it being `card`. Either may be None."""
+    before, after = _card_tally(previous), _card_tally(card)
+    path = _summary_field_path(collection_name)
+    changes = {}
+    increments = {f'{path}.{field}': after[field] - before[field]
+                  for field in _SUMMARY_COUNTS if after[field] != before[field]}
+    if increments:
+        changes['$inc'] = increments
+    if card is not None and card.get('last_reviewed'):
+        changes['$max'] = {f'{path}.last_reviewed': card['last_reviewed']}
+    return changes
+
+
+def _deck_summaries(user_doc, collection_names):
+    """The summaries of decks the account owns, counting any that need it."""
+    meta = _collection_meta(user_doc)
+    stored = {name: meta.get(name, {}).get('summary') for name in collection_names}
+    summaries = {name: summary for name, summary in stored.items()
+                 if summary and summary.get('complete')}
+    uncounted = [name for name in collection_names if name not in summaries]
+    if not uncounted:
+        return summaries
+
+    for name, summary in _count_decks(user_doc, uncounted).items():
+        # Only kept if nothing has moved the summary since it was read;
+        # otherwise the next read counts again.
+        path = _summary_field_path(name)
+        _update_user(user_doc['user_email'], {'$set': {path: summary}},
+                     match={path: stored[name]})
+        summaries[name] = summary
+    return {name: summaries[name] for name in collection_names}
+
+
+def _deck_summary(user_doc, collection_name):
+    return _deck_summaries(user_doc, [collection_name])[collection_name]
+
+
+# Counting a deck from its cards is done by MongoDB where it can be, so the
+# cards never leave the server: grouping the card documents of an account
+# keeping them in the cards collection, or walking `collections` with
+# $objectToArray for one keeping them in its document. Counting in Python
+# with _summary_of() remains for documents not in the current shape, whose
+# cards may still be sentinel strings, and for servers that refuse the
+# pipeline.
+
+def _summary_stages(cards):
+    """Expressions counting a summary from `cards`, an array of card documents."""
+    studied = {'$gt': [{'$ifNull': ['$$this.seen', 0]}, 0]}
+    return {
+        'total': {'$size': cards},
+        'studied': {'$size': {'$filter': {'input': cards, 'cond': studied}}},
+        'known': {'$size': {'$filter': {'input': cards, 'cond': {
+            '$and': [studied, {'$ne': ['$$this.needs_review', True]}]}}}},
+        'needs_review': {'$size': {'$filter': {'input': cards, 'cond': {
+            '$eq': ['$$this.needs_review', True]}}}},
+        'correct': {'$sum': f'{cards}.correct'},
+        'incorrect': {'$sum': f'{cards}.incorrect'},
+        'last_reviewed': {'$max': f'{cards}.last_reviewed'},
+    }
+
+
+def _embedded_summary_pipeline(email, collection_names):
+    return [
+        {'$match': {'user_email': email}},
+        {'$limit': 1},
+        {'$project': {'_id': 0, 'deck': {'$objectToArray': '$collections'}}},
+        {'$unwind': '$deck'},
+        {'$match': {'deck.k': {'$in': [_escape_key(name) for name in collection_names]}}},
+        {'$project': {'name': '$deck.k',
+                      'cards': {'$map': {'input': {'$objectToArray': '$deck.v'}, 'in': '$$this.v'}}}},
+        {'$project': {'name': 1, **_summary_stages('$cards')}},
+    ]
+
+
+def _card_documents_summary_pipeline(email, collection_names):
+    return [
+        {'$match': {'user_email': email, 'collection': {'$in': list(collection_names)}}},
+        {'$group': {'_id': '$collection',
+                    'cards': {'$push': {field: f'${field}' for field in
+                                        ('seen', 'needs_review', 'correct', 'incorrect',
+                                         'last_reviewed')}}}},
+        {'$project': {'_id': 0, 'name': '$_id', **_summary_stages('$cards')}},
+    ]
+
+
+def _count_decks(user_doc, collection_names):
+    """Complete summaries of the given owned decks, counted from their cards."""
+    email = user_doc['user_email']
+    rows = None
+    try:
+        if _cards_in_collection(user_doc):
+            rows = [{**row, 'name': _escape_key(row['name'])} for row in cards_collection.aggregate(
+                _card_documents_summary_pipeline(email, collection_names))]
+        elif _is_current(user_doc):
+            rows = list(flashcards_collection.aggregate(
+                _embedded_summary_pipeline(email, collection_names)))
+    except OperationFailure:
+        rows = None
+    if rows is None:
+        return {name: _summary_of(_owned_deck(user_doc, name) or {}) for name in collection_names}
+
+    # A deck with no cards has no card documents to group.
+    counted = {name: _summary_of({}) for name in collection_names}
+    for row in rows:
+        summary = {field: row[field] for field in _SUMMARY_COUNTS}
+        if row.get('last_reviewed'):
+            summary['last_reviewed'] = row['last_reviewed']
+        summary['complete'] = True
+        counted[_unescape_key(row['name'])] = summary
+    return counted
+
+
+def _progress_of(summary):
+    """What the deck list shows for a deck: 'how ready am I?' at a glance."""
+    return {
+        'total': summary['total'],
+        'known': summary['known'],
+        'needs_review': summary['needs_review'],
+        'studied': summary['studied'],
+        'last_reviewed': summary.get('last_reviewed'),
+    }
+
+
+# Delta sync
+#
+# A client holding a deck asks /api/cards/changes for what has changed in it
+# since it last looked, rather than fetching every card again. Each write to a
+# card stamps it with `changed`, in milliseconds; a deleted card leaves a
+# tombstone, the time it went, in collection_meta.<deck>.deleted, dropped after
+# SYNC_TOMBSTONE_TTL seconds. A follower's progress on a card is stamped the
+# same way.
+#
+# Each deck also has a `sync_id`, given to it on its first write and replaced
+# whenever it is written whole. A cursor is that id and the time it was handed
+# out. One naming another id -- the deck was replaced, or deleted and made
+# again -- or older than the tombstones go back gets the whole deck instead.
+#
+# Cards are stamped by the clock of whichever worker wrote them, so changes are
+# looked for SYNC_OVERLAP_MS before the cursor: a client may be sent a change
+# twice, but never misses one.
+
+SYNC_TOMBSTONE_TTL = int(os.environ.get('SYNC_TOMBSTONE_TTL', 30 * 24 * 3600))
+SYNC_OVERLAP_MS = 30_000
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _sync_changes(owner_doc, collection_name, deleted=()):
+    """The update operators that keep a deck's sync state with a write to it:
+    a sync_id if it has none yet, and tombstones for the `deleted` terms, with
+    any that have expired cleared."""
+    meta = owner_doc.setdefault('collection_meta', {}).setdefault(collection_name, {})
+    path = _meta_field_path(collection_name)
+    changes = {}
+    if not meta.get('sync_id'):
+        meta['sync_id'] = secrets.token_hex(6)
+        changes['$set'] = {f'{path}.sync_id': meta['sync_id']}
+    if deleted:
+        now = _now_ms()
+        changes.setdefault('$set', {}).update(
+            {f'{path}.deleted.{_escape_key(term)}': now for term in deleted})
+        expired = [term for term, at in (meta.get('deleted') or {}).items()
+                   if at < now - SYNC_TOMBSTONE_TTL * 1000 and term not in deleted]
+        if expired:
+            changes['$unset'] = {f'{path}.deleted.{_escape_key(term)}': "" for term in expired}
+    return changes
+
+
+def _changed_cards(owner_doc, collection_name, after, terms=()):
+    """The cards of an owned deck written after `after`, along with any of
+    `terms` it has, as term -> card."""
+    if not _cards_in_collection(owner_doc):
+        terms = set(terms)
+        return {term: card for term, card in (_owned_deck(owner_doc, collection_name) or {}).items()
+                if term in terms or (isinstance(card, dict) and (card.get('changed') or 0) > after)}
+    return _deck_from_documents(cards_collection.find(
+        {'user_email': owner_doc['user_email'], 'collection': collection_name,
+         '$or': [{'changed': {'$gt': after}}, {'term': {'$in': list(terms)}}]},
+        _CARD_DOCUMENT_PROJECTION,
+    ))
+
+
+def _parse_cursor(cursor):
+    """(sync_id, time) from a cursor, or (None, None) for none or a bad one."""
+    sync_id, _, at = (cursor or '').rpartition(':')
+    try:
+        return sync_id, int(at)
+    except ValueError:
+        return None, None
+
+
+# Writing cards
+#
+# Every card of every deck sits in the one user document, so `$set`-ing the
+# whole `collections` map after changing a single card costs a write -- and an
+# oplog entry -- the size of the account. These address just the part that
+# changed, in whichever place the account keeps its cards.
+#
+# Writes to cards kept in the document only match while the account is still
+# stored that way. A request that read the account just before
+# migrate-card-store switched it over then misses, instead of writing a card
+# into a placeholder where nothing would ever read it, and is redone against
+# the cards collection.
+#
+# A deck's summary is moved by the difference a write makes to a card, so the
+# write must only land on the card as it was read. A delete or create that
+# another request got to first -- a double tap, or a retry on another worker --
+# would otherwise count twice, in a summary marked complete that is never
+# counted again. In the document, the update matches only while the card is
+# there, or is not, as it was read; in the cards collection, the card as it
+# was before the write comes back from the write itself.
+
+
+def _collection_field_path(collection_name):
+    return f'collections.{_escape_key(collection_name)}'
+
+
+def _card_field_path(collection_name, term):
+    return f'{_collection_field_path(collection_name)}.{_escape_key(term)}'
+
+
+def _meta_field_path(collection_name):
+    return f'collection_meta.{_escape_key(collection_name)}'
+
+
+def _link_field_path(collection_name):
+    return f'linked_collections.{_escape_key(collection_name)}'
+
+
+def _update_document_cards(owner_doc, update, match=None):
+    """Apply `update` to an account keeping its cards in its document.
+
+    Returns False if the account has moved them to the cards collection since
+    `owner_doc` was read; `owner_doc` is then marked as such so the caller can
+    write there instead. With `match`, the update only applies while the
+    document matches it too, and None is returned if it does not.
+    """
+    result = _update_user(owner_doc['user_email'], update,
+                          match={'card_store': {'$exists': False}, **(match or {})})
+    if result.matched_count:
+        return True
+    current = flashcards_collection.find_one({'user_email': owner_doc['user_email']},
+                                             {'card_store': 1})
+    if current is None:
+        return True
+    if not _cards_in_collection(current):
+        return None if match else True
+    owner_doc['card_store'] = CARD_STORE_COLLECTION
+    return False
+
+
+def _card_exists(collection_name, term, exists):
+    """An update filter matching while a card kept in the document is there,
+    or is not."""
+    return {_card_field_path(collection_name, term): {'$exists': exists}}
+
+
+def _stored_card(owner_doc, collection_name, term):
+    """A card kept in the document as it is stored now, or None."""
+    found = flashcards_collection.find_one({'user_email': owner_doc['user_email']},
+                                           {_card_field_path(collection_name, term): 1})
+    deck = ((found or {}).get('collections') or {}).get(_escape_key(collection_name)) or {}
+    return deck.get(_escape_key(term))
+
+
+def _touch_deck(owner_doc, collection_name, summary_changes=None):
+    """Record a change to a deck kept in the cards collection on the account:
+    the deck is listed (creating it if need be), its summary moved, and the
+    account marked updated."""
+    update = {'$set': {_collection_field_path(collection_name): {},
+                       'updated_at': datetime.utcnow()}}
+    _merge_update(update, summary_changes or {})
+    _update_user(owner_doc['user_email'], update)
+
+
+def _merge_update(update, changes):
+    for operator, fields in changes.items():
+        update.setdefault(operator, {}).update(fields)
+    return update
+
+
+# How many times a card write is worked out again when the card has been
+# created or deleted under it, before giving up with a 409.
+WRITE_ATTEMPTS = 5
+
+
+class WriteConflict(Exception):
+    pass
+
+
+@app.errorhandler(WriteConflict)
+def handle_write_conflict(error):
+    app.logger.warning(f"Write conflict: {error}")
+    return _json_response({"status": 409, "error": "That card is being changed elsewhere. Try again."}), 409
+
+
+def _write_collection(owner_doc, collection_name, cards):
+    """Persist one whole collection, e.g. one just created or imported."""
+    changed = _now_ms()
+    cards = {term: {**card, 'changed': changed} for term, card in cards.items()}
+    # A new sync_id: whatever a client held of a deck by this name, this is not it.
+    summary = {'$set': {_summary_field_path(collection_name): _summary_of(cards),
+                        f'{_meta_field_path(collection_name)}.sync_id': secrets.token_hex(6)}}
+    if not _cards_in_collection(owner_doc):
+        if _update_document_cards(owner_doc, _merge_update({'$set': {
+            _collection_field_path(collection_name): _escaped_cards(cards),
+            'updated_at': datetime.utcnow(),
+        }}, summary)):
+            return
+
+    owner_email = owner_doc['user_email']
+    if cards:
+        cards_collection.insert_many(
+            [_card_document(owner_email, collection_name, term, card) for term, card in cards.items()],
+            ordered=False,
+        )
+    _touch_deck(owner_doc, collection_name, summary)
+
+
+def _write_card(owner_doc, collection_name, term, card, replaced_term=None, previous=None):
+    """Persist one card, replacing the term it had when it was renamed.
+
+    `previous` is the card as it was stored before, None for a new one.
+    """
+    renamed = bool(replaced_term) and replaced_term != term
+    source = replaced_term if renamed else term
+    card = {**card, 'changed': _now_ms()}
+    sync = _sync_changes(owner_doc, collection_name, deleted=[replaced_term] if renamed else ())
+    if not _cards_in_collection(owner_doc):
+        for _ in range(WRITE_ATTEMPTS):
+            update = {'$set': {_card_field_path(collection_name, term): card,
+                               'updated_at': datetime.utcnow()}}
+            if renamed:
+                update['$unset'] = {_card_field_path(collection_name, replaced_term): ""}
+            _merge_update(update, _summary_changes(collection_name, previous, card))
+            written = _update_document_cards(owner_doc, _merge_update(update, sync),
+                                             match=_card_exists(collection_name, source, previous is not None))
+            if written is not None:
+                break
+            # Created or deleted by another request since it was read.
+            previous = _stored_card(owner_doc, collection_name, source)
+        else:
+            raise WriteConflict(f'{term!r} kept changing while it was being written')
+        if written:
+            return
+
+    owner_email = owner_doc['user_email']
+    previous = cards_collection.find_one_and_update(
+        _card_key(owner_email, collection_name, source), {'$set': {**card, 'term': term}},
+        projection=_CARD_DOCUMENT_PROJECTION, upsert=True)
+    _touch_deck(owner_doc, collection_name,
+                _merge_update(_summary_changes(collection_name, previous, card), sync))
+
+
+def _delete_card(owner_doc, collection_name, term, previous):
+    """Delete one card. Returns False if there was none to delete by the
+    time it got there -- another request deleted it first."""
+    sync = _sync_changes(owner_doc, collection_name, deleted=[term])
+    if not _cards_in_collection(owner_doc):
+        deleted = _update_document_cards(owner_doc, _merge_update({
+            '$unset': {_card_field_path(collection_name, term): ""},
+            '$set': {'updated_at': datetime.utcnow()},
+        }, _merge_update(_summary_changes(collection_name, previous, None), sync)),
+            match=_card_exists(collection_name, term, True))
+        if deleted is not False:
+            return bool(deleted)
+
+    previous = cards_collection.find_one_and_delete(
+        _card_key(owner_doc['user_email'], collection_name, term), projection=_CARD_DOCUMENT_PROJECTION)
+    if previous is None:
+        return False
+    _touch_deck(owner_doc, collection_name,
+                _merge_update(_summary_changes(collection_name, previous, None), sync))
+    return True
+
+
+def _write_review(owner_doc, collection_name, term, card, outcome, previous):
+    """Persist a review of one card as counter increments.
+
+    `card` is the card after the review, `previous` before it. Incrementing
+    rather than setting the counts means two devices reviewing at once both
+    get counted.
+    """
+    summary = _merge_update(_summary_changes(collection_name, previous, card),
+                            _sync_changes(owner_doc, collection_name))
+    changed = _now_ms()
+    if not _cards_in_collection(owner_doc):
+        path = _card_field_path(collection_name, term)
+        # None, for a card deleted since it was read, leaves it deleted.
+        if _update_document_cards(owner_doc, _merge_update({
+            '$inc': {f'{path}.seen': 1, f'{path}.{outcome}': 1},
+            '$set': {
+                f'{path}.needs_review': card['needs_review'],
+                f'{path}.last_reviewed': card['last_reviewed'],
+                f'{path}.changed': changed,
+                'updated_at': datetime.utcnow(),
+            },
+        }, summary), match=_card_exists(collection_name, term, True)) is not False:
+            return
+
+    result = cards_collection.update_one(
+        _card_key(owner_doc['user_email'], collection_name, term),
+        {'$inc': {'seen': 1, outcome: 1},
+         '$set': {'needs_review': card['needs_review'], 'last_reviewed': card['last_reviewed'],
+                  'changed': changed}},
+    )
+    if result.matched_count:
+        _touch_deck(owner_doc, collection_name, summary)
+
+
+def _drop_collection(owner_doc, collection_name, default_collection):
+    """Remove a deck, its settings, and -- wherever they are kept -- its cards."""
+    update = {
+        '$unset': {_collection_field_path(collection_name): "",
+                   _meta_field_path(collection_name): ""},
+        '$set': {'default_collection': default_collection, 'updated_at': datetime.utcnow()},
+    }
+    if not _cards_in_collection(owner_doc) and _update_document_cards(owner_doc, update):
+        return
+    _update_user(owner_doc['user_email'], update)
+    cards_collection.delete_many({'user_email': owner_doc['user_email'],
+                                  'collection': collection_name})
+
+
+def _rename_collection(owner_doc, old_name, new_name, default_collection):
+    """Move a deck, its settings and its cards to a new name.
+
+    Moved server-side either way, so the cards never cross the wire.
+    """
+    # Per-deck settings are keyed by name too, so the cover and the summary
+    # move with it. Renaming a field that is not there does nothing.
+    renames = {_collection_field_path(old_name): _collection_field_path(new_name),
+               _meta_field_path(old_name): _meta_field_path(new_name)}
+    update = {
+        '$rename': renames,
+        '$set': {'default_collection': default_collection, 'updated_at': datetime.utcnow()},
+    }
+    if not _cards_in_collection(owner_doc) and _update_document_cards(owner_doc, update):
+        return
+    _update_user(owner_doc['user_email'], update)
+    cards_collection.update_many({'user_email': owner_doc['user_email'], 'collection': old_name},
+                                 {'$set': {'collection': new_name}})
+
+
+def _move_cards_to_collection(email, batch_size, attempts=5):
+    """Move one account's cards out of its document. Returns how many moved,
+    or None if the account kept changing under every attempt.
+
+    Runs against a live account: the cards are copied first and the account is
+    switched over only if nothing has written to it since it was read, which
+    every write marks by setting updated_at. Anything copied by an attempt that
+    lost that race is cleared by the next one.
+    """
+    for _ in range(attempts):
+        user_doc = _load_user(email)
+        if user_doc is None or _cards_in_collection(user_doc):
+            return 0
+        collections = _owned_decks(user_doc)
+
+        cards_collection.delete_many({'user_email': email})
+        moved = 0
+        batch = []
+        for name, cards in collections.items():
+            for term, card in cards.items():
+                batch.append(_card_document(email, name, term, card))
+                if len(batch) >= batch_size:
+                    cards_collection.insert_many(batch, ordered=False)
+                    moved += len(batch)
+                    batch = []
+        if batch:
+            cards_collection.insert_many(batch, ordered=False)
+            moved += len(batch)
+
+        switched = _update_user(
+            email,
+            {'$set': {'card_store': CARD_STORE_COLLECTION,
+                      'collections': {_escape_key(name): {} for name in collections},
+                      'schema_version': SCHEMA_VERSION},
+             '$unset': {'normalised_decks': ''}},
+            match={'_id': user_doc['_id'], 'updated_at': user_doc.get('updated_at'),
+                   'card_store': {'$exists': False}},
+        )
+        if switched.modified_count:
+            return moved
+    return None
+
+
 # Deck covers
 #
 # `collections` maps a name straight to its cards, and everything in this file
@@ -160,19 +1045,61 @@ def _names_for(emails):
     wanted = {e for e in emails if e}
     if not wanted or flashcards_collection is None:
         return {}
-    found = {
-        doc['user_email']: _display_name_of(doc)
-        for doc in flashcards_collection.find(
-            {'user_email': {'$in': list(wanted)}},
-            {'user_email': 1, 'display_name': 1},
-        )
-    }
+    epoch = _display_name_epoch
+    found = {}
+    for e in wanted:
+        name = _display_names.get(e, _UNKNOWN_NAME)
+        if name is not _UNKNOWN_NAME:
+            found[e] = name
+    missing = [e for e in wanted if e not in found]
+    if missing:
+        # Whatever is missing is fetched together: one round trip to Redis
+        # and at most one query, however many contributors a deck has.
+        loaded = {}
+        if _shared_cache is not None:
+            held = _shared_cache.get_many([f'name:{e}' for e in missing])
+            loaded = {e: name['name'] for e, name in zip(missing, held) if name is not None}
+        unknown = [e for e in missing if e not in loaded]
+        if unknown:
+            stored = {
+                doc['user_email']: _display_name_of(doc)
+                for doc in flashcards_collection.find(
+                    {'user_email': {'$in': unknown}},
+                    {'user_email': 1, 'display_name': 1},
+                )
+            }
+            stored = {e: stored.get(e) for e in unknown}
+            if _shared_cache is not None:
+                _shared_cache.set_many({f'name:{e}': {'name': name} for e, name in stored.items()})
+            loaded.update(stored)
+        if epoch == _display_name_epoch:
+            expires_at = time.time() + NAME_CACHE_TTL
+            for e, name in loaded.items():
+                _display_names.set(e, name, expires_at=expires_at)
+        found.update(loaded)
     # An account that never set a name, or that no longer exists, still has to
     # be called something. The part before the @ is the least bad option, and
     # unlike the address itself it is not something a stranger can write to.
     return {e: (found.get(e) or e.split('@')[0]) for e in wanted}
 
 
+def _forget_display_name(email):
+    global _display_name_epoch
+    _display_name_epoch += 1
+    _display_names.pop(email)
+    if _shared_cache is not None:
+        _shared_cache.delete(f'name:{email}')
+
+
+def _authors(card, owner_email):
+    """(creator, editor) of a normalised card, the editor None when there is
+    none worth showing."""
+    creator = card.get('created_by') or owner_email
+    editor = card.get('edited_by')
+    # An edit by the person who wrote the card says nothing worth a line.
+    return creator, editor if editor and editor != creator else None
+
+
 def _attribute(cards, owner_email, viewer_email):
     """Card payloads carrying who wrote each card, and whether to show it.
 
@@ -185,32 +1112,607 @@ def _attribute(cards, owner_email, viewer_email):
     card is that person's. Resolving it at read time this way means no
     migration has to run over decks people are studying right now.
     """
-    creators, editors = {}, {}
+    attributed = []
     for term, value in cards.items():
         card = _normalise_card(value)
-        creator = card.get('created_by') or owner_email
-        editor = card.get('edited_by')
-        creators[term] = creator
-        # An edit by the person who wrote the card says nothing worth a line.
-        editors[term] = editor if editor and editor != creator else None
-
-    contributors = {c for c in creators.values() if c}
-    contributors |= {e for e in editors.values() if e}
-    names = _names_for(contributors)
+        attributed.append((term, card, *_authors(card, owner_email)))
 
-    payload = []
-    for term, value in cards.items():
-        card = _normalise_card(value)
-        creator, editor = creators[term], editors[term]
-        card['created_by_name'] = names.get(creator)
-        card['created_by_you'] = bool(creator) and creator == viewer_email
-        card['edited_by_name'] = names.get(editor) if editor else None
-        card['edited_by_you'] = bool(editor) and editor == viewer_email
-        payload.append(_card_payload(term, card))
+    contributors = {c for _, _, c, _ in attributed if c}
+    contributors |= {e for _, _, _, e in attributed if e}
+    names = _names_for(contributors)
 
+    payload = [_attributed(term, card, creator, editor, viewer_email, names)
+               for term, card, creator, editor in attributed]
     return payload, len(contributors) > 1
 
 
+def _attributed(term, card, creator, editor, viewer_email, names):
+    """The payload of one normalised card, its authors named from `names`."""
+    card['created_by_name'] = names.get(creator)
+    card['created_by_you'] = bool(creator) and creator == viewer_email
+    card['edited_by_name'] = names.get(editor) if editor else None
+    card['edited_by_you'] = bool(editor) and editor == viewer_email
+    return _card_payload(term, card)
+
+
+# Caches
+#
+# In-process caches for things read far more often than they change. Each
+# worker process has its own, so anything cached here has to be either
+# immutable or invalidated by the writes that change it.
+
+_caches = {}
+
+
+class _LRUCache:
+    """A bounded mapping that drops the least recently used entry when full.
+
+    An entry may be given an expiry, as a Unix time, after which it is treated
+    as absent. Safe to share between threads. Counts hits and misses, so a
+    cache that is not earning its memory shows up; a named one is listed by
+    /api/cache/stats.
+    """
+
+    def __init__(self, max_size, name=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            _caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at=None):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Display names for attributing cards, by email; see _names_for(). Only
+# save_profile() changes a name, and it drops it here at once; another
+# worker's copy lasts at most NAME_CACHE_TTL seconds more. An account with no
+# name is remembered as None, so it is not looked up again either.
+NAME_CACHE_SIZE = int(os.environ.get('NAME_CACHE_SIZE', 10000))
+NAME_CACHE_TTL = int(os.environ.get('NAME_CACHE_TTL', 300))
+_display_names = _LRUCache(NAME_CACHE_SIZE, name='display_names')
+_UNKNOWN_NAME = object()
+# Moved on by every name change, so that a lookup which read a name from
+# before the change does not keep it.
+_display_name_epoch = 0
+
+
+# Shared cache
+#
+# With several worker processes behind a load balancer, a person's requests
+# land on whichever worker is free, so a cache kept per process sees only a
+# fraction of the hits -- and a copy one worker holds can be changed through
+# another. With REDIS_URL set, user documents, share links and display names
+# are also kept in Redis, where every worker finds them. The writes that change
+# them delete them there as they happen, and every entry has a TTL besides, so
+# a change made behind the server's back is not served for long.
+#
+# Redis is never needed to answer a request. If it cannot be reached, reads
+# fall through to MongoDB and it is left alone for a few seconds rather than
+# made to time out on every call.
+#
+# Values are BSON, which keeps dates and ObjectIds what they were, compressed
+# when large. `REDIS_URL=local://` keeps the shared cache inside the process
+# instead, for tests and benchmarks.
+
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', 0.25))
+REDIS_RETRY_AFTER = 5
+SHARED_CACHE_TTL = int(os.environ.get('SHARED_CACHE_TTL', 3600))
+SHARED_COMPRESS_ABOVE = 1024
+
+
+def _pack(document):
+    """A document, or its BSON, as the shared cache stores it."""
+    raw = document if isinstance(document, bytes) else bson.encode(document)
+    if len(raw) > SHARED_COMPRESS_ABOVE:
+        return b'z' + zlib.compress(raw, 1)
+    return b'b' + raw
+
+
+def _unpack(packed):
+    raw = packed[1:]
+    if packed[:1] == b'z':
+        raw = zlib.decompress(raw)
+    return bson.decode(raw)
+
+
+class _LocalRedis:
+    """The few Redis commands the shared cache uses, kept in a dict."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _live(self, name):
+        value, expires_at = self._values.get(name, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            del self._values[name]
+            return None
+        return value
+
+    def get(self, name):
+        with self._lock:
+            return self._live(name)
+
+    def mget(self, names):
+        with self._lock:
+            return [self._live(name) for name in names]
+
+    def set(self, name, value, ex=None, nx=False):
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            if nx and self._live(name) is not None:
+                return None
+            self._values[name] = (value, time.time() + ex if ex else None)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._values.pop(name, None) is not None for name in names)
+
+    def pipeline(self, transaction=True):
+        return _LocalRedisPipeline(self)
+
+
+class _LocalRedisPipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self._calls.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [getattr(self._redis, command)(*args, **kwargs) for command, args, kwargs in calls]
+
+
+class _SharedCache:
+    """Redis, used as a cache: keys are namespaced to the database, values
+    packed, and failures taken as misses. Counts hits and misses and keeps the
+    latency of recent calls, for /api/cache/stats."""
+
+    def __init__(self, redis, namespace):
+        self.redis = redis
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+        self._down_until = 0
+
+    def _run(self, call, *args, **kwargs):
+        if time.time() < self._down_until:
+            raise ConnectionError('Redis is unavailable')
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        except Exception as error:
+            self.errors += 1
+            self._down_until = time.time() + REDIS_RETRY_AFTER
+            app.logger.warning(f"Shared cache unavailable, retrying in {REDIS_RETRY_AFTER}s: {error}")
+            raise ConnectionError(str(error)) from error
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}'
+
+    def get_many(self, keys):
+        """The documents held for `keys`, with None for each one missing."""
+        try:
+            found = self._run(self.redis.mget, [self._key(key) for key in keys])
+        except ConnectionError:
+            return [None] * len(keys)
+        values = [_unpack(packed) if packed is not None else None for packed in found]
+        hits = sum(value is not None for value in values)
+        self.hits += hits
+        self.misses += len(values) - hits
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set_many(self, documents, ttl=SHARED_CACHE_TTL):
+        """Hold each document of the `documents` dict for `ttl` seconds."""
+        if not documents:
+            return
+        packed = {self._key(key): _pack(document) for key, document in documents.items()}
+
+        def write():
+            pipe = self.redis.pipeline(transaction=False)
+            for key, value in packed.items():
+                pipe.set(key, value, ex=ttl)
+            return pipe.execute()
+
+        try:
+            self._run(write)
+        except ConnectionError:
+            pass
+
+    def set(self, key, document, ttl=SHARED_CACHE_TTL):
+        self.set_many({key: document}, ttl)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            self._run(self.redis.delete, *[self._key(key) for key in keys])
+        except ConnectionError:
+            pass
+
+    def token(self, key, create=False, ttl=SHARED_CACHE_TTL):
+        """The random token held at `key` -- set first, if `create` and there
+        is none -- or None."""
+        key = self._key(key)
+        try:
+            token = self._run(self.redis.get, key)
+            if token is None and create:
+                self._run(self.redis.set, key, secrets.token_hex(8), ex=ttl, nx=True)
+                token = self._run(self.redis.get, key)
+        except ConnectionError:
+            return None
+        return token.decode() if isinstance(token, bytes) else token
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        lookups = self.hits + self.misses
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            index = min(len(latencies) - 1, int(len(latencies) * fraction))
+            return round(latencies[index] * 1000, 3)
+
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'latency_ms': {'p50': percentile(0.5), 'p99': percentile(0.99)}}
+
+
+def _connect_shared_cache(url):
+    if not url:
+        return None
+    if url == 'local://':
+        redis = _LocalRedis()
+    else:
+        # Only needed when a Redis is configured.
+        import redis as redis_client
+        redis = redis_client.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT,
+                                            socket_connect_timeout=REDIS_TIMEOUT)
+    return _SharedCache(redis, mongo_database)
+
+
+_shared_cache = _connect_shared_cache(REDIS_URL)
+
+
+# User documents
+#
+# Nearly every request starts by loading the caller's user document, and a
+# study session asks for the same one dozens of times a minute. The most
+# recently used ones are kept here, already decoded, as BSON: decoding that
+# hands each request dicts of its own, far faster than copying them would, so
+# a handler is free to change what it is given.
+#
+# Every write to a user document goes through _update_user(), which moves the
+# document's `revision` on and drops the copy held here. A load that raced the
+# write is not kept. That leaves other processes' writes. With a shared cache,
+# each account has a generation there: a random token that every write
+# deletes, and that copies -- in Redis and in every process -- are held under.
+# A copy whose generation is no longer current is dropped. Without one, a
+# copy USER_CACHE_TTL seconds old is checked against the stored revision --
+# one small indexed read -- before it is used again.
+#
+# A write whose delete cannot reach Redis leaves the other processes holding
+# the old generation, so generations last USER_CACHE_TTL seconds rather than
+# SHARED_CACHE_TTL: that bounds how long a copy goes unchecked either way.
+#
+# Only reads are served from these copies. A request that writes builds its
+# writes from what it loads, and a copy even a moment old would have it write
+# back a card as it was before another worker's change to it, so anything
+# other than a GET loads the document afresh -- and keeps what it loads, for
+# the reads that follow.
+#
+# Finding no account is remembered too, for NEGATIVE_CACHE_TTL seconds, since
+# crawlers and stale clients ask for the same unknown email over and over.
+# Creating the account forgets it, like any other write, but only in the
+# process that created it; so, like any other cached copy, it is only ever
+# believed by reads. A write that finds no account and goes to create one may
+# still lose the race to another worker doing the same, and _insert_user()
+# says when it has.
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 10))
+_user_cache = _LRUCache(USER_CACHE_SIZE, name='users')
+_user_cache_lock = threading.Lock()
+
+
+class _CachedUser:
+    """What is held for one account: the generation and revision its loads
+    were made at, when that was last confirmed, and the loads themselves --
+    the whole document, its outline, or one deck of it -- encoded. Or, until
+    `absent_until`, that there is no such account."""
+
+    def __init__(self, generation=None):
+        self.generation = generation
+        self.revision = -1
+        self.checked_at = 0
+        self.loads = {}
+        self.absent_until = None
+
+
+# What _cached_user() returns for an account known not to exist.
+_ABSENT = object()
+
+
+def _user_generation(email, create=False):
+    if _shared_cache is None:
+        return None
+    return _shared_cache.token(f'user-generation:{email}', create=create, ttl=USER_CACHE_TTL)
+
+
+def _reads_cached():
+    """Whether this request may be served a cached copy of a document."""
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def _cached_copy_current(email, entry):
+    expected = _expected_revision(email)
+    if expected is not None and (entry.absent_until is not None
+                                 or (entry.loads and entry.revision < expected)):
+        return False
+    if entry.absent_until is not None and entry.absent_until <= time.time():
+        return False
+    generation = _user_generation(email)
+    if generation is not None or entry.generation is not None:
+        return generation == entry.generation
+    if entry.absent_until is not None or time.time() - entry.checked_at <= USER_CACHE_TTL:
+        return True
+    stored = flashcards_collection.find_one({'user_email': email}, {'revision': 1})
+    if stored is None or stored.get('revision', 0) != entry.revision:
+        return False
+    entry.checked_at = time.time()
+    return True
+
+
+def _cached_user(email, *kinds):
+    """Returns (entry, user_doc): the entry a load of `email` is to be kept in,
+    and the first of `kinds` of load already made this request, or a fresh
+    copy of one held, or _ABSENT if there is no such account, or None.
+
+    The entry is taken before the load is made, so that a write landing during
+    the load can be noticed.
+    """
+    for kind in kinds:
+        user_doc = _mapped(('user', email, kind))
+        if user_doc is not None:
+            return None, user_doc
+    cached_reads = _reads_cached()
+    entry = _user_cache.get(email)
+    if entry is not None and (not cached_reads or not _cached_copy_current(email, entry)):
+        _user_cache.pop(email)
+        entry = None
+    if entry is None:
+        generation = _user_generation(email, create=True)
+        with _user_cache_lock:
+            entry = _user_cache.get(email)
+            if entry is None or not cached_reads:
+                entry = _CachedUser(generation)
+                _user_cache.set(email, entry)
+    if not cached_reads:
+        return entry, None
+
+    if entry.absent_until is not None:
+        return entry, _ABSENT
+    kind = next((kind for kind in kinds if kind in entry.loads), None)
+    if kind is not None:
+        user_doc = bson.decode(entry.loads[kind])
+        _map(('user', email, kind), user_doc)
+        return entry, user_doc
+    if entry.generation is not None:
+        shared = _shared_cache.get_many([_user_key(email, entry.generation, kind) for kind in kinds])
+        expected = _expected_revision(email) or 0
+        for kind, user_doc in zip(kinds, shared):
+            if user_doc is not None and user_doc.get('revision', 0) >= expected:
+                _keep_user(email, entry, kind, user_doc, shared=False)
+                return entry, user_doc
+    return entry, None
+
+
+def _user_key(email, generation, kind):
+    return f'user:{email}:{generation}:{kind}'
+
+
+def _keep_user(email, entry, kind, user_doc, shared=True):
+    """Hold on to a load, unless the account has been written to since
+    `entry` was taken."""
+    _map(('user', email, kind), user_doc)
+    revision = user_doc.get('revision', 0)
+    raw = bson.encode(user_doc)
+    if shared and entry.generation is not None:
+        _shared_cache.set(_user_key(email, entry.generation, kind), raw)
+    with _user_cache_lock:
+        if _user_cache.get(email) is not entry or revision < entry.revision:
+            return
+        if revision > entry.revision:
+            entry.revision = revision
+            entry.loads = {}
+        entry.checked_at = time.time()
+        entry.loads[kind] = raw
+
+
+def _keep_absent(email, entry):
+    """Remember that `email` has no account, unless one has been created since
+    `entry` was taken."""
+    with _user_cache_lock:
+        if _user_cache.get(email) is entry and not entry.loads:
+            entry.absent_until = time.time() + NEGATIVE_CACHE_TTL
+
+
+def _forget_user(email):
+    """Drop every copy of an account's document, here and in other processes."""
+    _unmap(lambda key: key[:2] == ('user', email))
+    _user_cache.pop(email)
+    if _shared_cache is not None:
+        _shared_cache.delete(f'user-generation:{email}')
+
+
+def _update_user(email, update, match=None, upsert=False):
+    """Apply `update` to an account's document, moving its revision on and
+    dropping any copy of it held. `match` narrows which document state the
+    update applies to."""
+    update = {**update, '$inc': {**update.get('$inc', {}), 'revision': 1}}
+    result = flashcards_collection.update_one({'user_email': email, **(match or {})},
+                                              update, upsert=upsert)
+    _forget_user(email)
+    return result
+
+
+# Request identity map
+#
+# Within one request the same document is often wanted by several helpers:
+# /api/cards resolves a followed deck's share to find the cards and again to
+# name their owner, and a handler may reload the account it just migrated.
+# Each user document and share is loaded at most once per request and the
+# same object handed to everything that asks for it after, so a change one
+# helper makes to it is seen by the next. A write drops what it changed, so
+# nothing loaded after a write predates it.
+#
+# With FLASK_DEBUG on, each response says in X-Lookups-Saved how many loads
+# this spared, and the log says which request it was.
+
+def _request_documents():
+    """The current request's identity map, or None outside a request."""
+    if not has_request_context():
+        return None
+    if 'documents' not in g:
+        g.documents = {}
+        g.lookups_saved = 0
+    return g.documents
+
+
+def _mapped(key):
+    documents = _request_documents()
+    document = documents.get(key) if documents is not None else None
+    if document is not None:
+        g.lookups_saved += 1
+    return document
+
+
+def _map(key, document):
+    documents = _request_documents()
+    if documents is not None and document is not None:
+        documents[key] = document
+
+
+def _unmap(matches):
+    documents = _request_documents()
+    for key in [key for key in documents or () if matches(key)]:
+        del documents[key]
+
+
+@app.after_request
+def _report_lookups_saved(response):
+    saved = g.get('lookups_saved')
+    if app.debug and saved:
+        response.headers['X-Lookups-Saved'] = str(saved)
+        app.logger.debug(f"{request.method} {request.path}: {saved} lookups saved")
+    return response
+
+
+# JSON responses
+#
+# Every response body is encoded by _json_response(), through one encoder:
+# orjson when it is installed, which is several times faster on a deck of
+# cards and understands datetimes itself, or the standard library's json
+# otherwise. JSON_ENCODER picks one by name. Either way the output is compact
+# UTF-8, dates are ISO 8601 and ObjectIds their hex string, so clients cannot
+# tell which encoded it. Flask's own jsonify() and the dicts views return are
+# sent through the same encoder.
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+JSON_ENCODERS = {'json': _stdlib_dumps}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def _orjson_dumps(value):
+        return orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+    JSON_ENCODERS['orjson'] = _orjson_dumps
+
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'orjson' if 'orjson' in JSON_ENCODERS else 'json')
+if JSON_ENCODER not in JSON_ENCODERS:
+    raise RuntimeError(f"JSON_ENCODER must be one of {', '.join(JSON_ENCODERS)}, not {JSON_ENCODER!r}")
+_json_dumps = JSON_ENCODERS[JSON_ENCODER]
+
+
+def _json_response(body):
+    """`body` as a JSON response."""
+    return Response(_json_dumps(body), mimetype='application/json')
+
+
+class _JSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return _json_dumps(obj).decode()
+
+    def response(self, *args, **kwargs):
+        return _json_response(self._prepare_response_obj(args, kwargs))
+
+
+app.json = _JSONProvider(app)
+
+
 # Error handler
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -220,7 +1722,7 @@ class AuthError(Exception):
 
 @app.errorhandler(AuthError)
 def handle_auth_error(ex):
-    response = jsonify(ex.error)
+    response = _json_response(ex.error)
     response.status_code = ex.status_code
     return response
 
@@ -237,124 +1739,642 @@ def get_token_auth_header():
                          "description":
                              "Authorization header is expected"}, 401)
 
-    parts = auth.split()
+    parts = auth.split()
+
+    if parts[0].lower() != "bearer":
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Authorization header must start with"
+                             " Bearer"}, 401)
+    elif len(parts) == 1:
+        raise AuthError({"code": "invalid_header",
+                         "description": "Token not found"}, 401)
+    elif len(parts) > 2:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Authorization header must be"
+                             " Bearer token"}, 401)
+
+    token = parts[1]
+    return token
+
+
+# Signing keys
+#
+# Tokens are checked against the keys Auth0 publishes. Fetching those on every
+# request put a network call in front of every authenticated endpoint, and
+# failed them all whenever Auth0 was slow. Instead a background thread keeps
+# them fresh: it refetches once they are JWKS_REFRESH_AHEAD of the way to
+# JWKS_TTL seconds old, so requests are served from the keys held and never
+# wait on Auth0. A failed fetch keeps the last keys that worked.
+#
+# A token signed with a key we do not have is what a key rotation looks like
+# from here, so it triggers a fetch straight away -- but no more than one per
+# JWKS_MIN_REFRESH seconds, or a stream of tokens with made-up key ids would
+# become a stream of fetches. Auth0 publishes the next key ahead of a
+# rotation, so the periodic refresh normally has it before any token does.
+#
+# Server processes share the keys through shared_state and take turns
+# fetching, under a lease: all of them coming due at once after a rotation
+# costs Auth0 one fetch, not one per process. JWKS_FILE reads the keys from
+# disk instead, for running offline.
+
+JWKS_URL = "https://" + AUTH0_DOMAIN + "/.well-known/jwks.json"
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH = int(os.environ.get('JWKS_MIN_REFRESH', 30))
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_REFRESH_AHEAD = 0.8
+# Longer than a fetch can take; see the timeout in _fetch_jwks().
+JWKS_LEASE_SECONDS = 10
+
+# `keys` maps key id to key. Times are Unix times, comparable across processes.
+_jwks = {'keys': {}, 'fetched_at': None, 'attempted_at': None, 'refresher_pid': None}
+_jwks_lock = threading.Lock()
+# Held by whichever thread of this process is fetching.
+_jwks_fetching = threading.Lock()
+
+
+def _fetch_jwks():
+    if JWKS_FILE:
+        with open(JWKS_FILE) as f:
+            return json.load(f)
+    with urlopen(JWKS_URL, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def _fetched_keys():
+    """Keys straight from the source, as (keys, fetched_at), or None."""
+    try:
+        jwks = _fetch_jwks()
+    except Exception as error:
+        app.logger.warning(f"Could not fetch signing keys, keeping the last ones: {error}")
+        return None
+    return [key for key in jwks.get('keys', []) if 'kid' in key], time.time()
+
+
+def _shared_keys_usable(stored, kid):
+    """Whether keys another process fetched will do, rather than fetching."""
+    if not stored or not stored.get('keys'):
+        return False
+    age = time.time() - stored['fetched_at']
+    if kid is not None:
+        # Waiting for a key: only if they have it, or are as recent as a
+        # fetch would be allowed to be anyway.
+        return any(key['kid'] == kid for key in stored['keys']) or age < JWKS_MIN_REFRESH
+    return age < JWKS_TTL * JWKS_REFRESH_AHEAD
+
+
+def _load_jwks(kid=None):
+    """Up-to-date keys as (keys, fetched_at), or None if there are none to be had.
+
+    Takes the copy another process stored if it will do. Otherwise fetches,
+    if no other process is; if one is, waits for its result.
+    """
+    if shared_state_collection is None:
+        return _fetched_keys()
+    try:
+        stored = shared_state_collection.find_one({'_id': 'jwks'})
+        if _shared_keys_usable(stored, kid):
+            return stored['keys'], stored['fetched_at']
+
+        now = time.time()
+        try:
+            shared_state_collection.update_one(
+                {'_id': 'jwks', '$or': [{'lease_until': {'$lt': now}},
+                                        {'lease_until': {'$exists': False}}]},
+                {'$set': {'lease_until': now + JWKS_LEASE_SECONDS}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The lease is held: another process is fetching.
+            while time.time() < now + JWKS_LEASE_SECONDS:
+                time.sleep(0.25)
+                stored = shared_state_collection.find_one({'_id': 'jwks'})
+                if stored and stored.get('fetched_at', 0) > now - JWKS_LEASE_SECONDS:
+                    return stored['keys'], stored['fetched_at']
+            return None
+
+        fetched = _fetched_keys()
+        update = {'$unset': {'lease_until': ''}}
+        if fetched:
+            update['$set'] = {'keys': fetched[0], 'fetched_at': fetched[1]}
+        shared_state_collection.update_one({'_id': 'jwks'}, update)
+        return fetched
+    except PyMongoError as error:
+        app.logger.warning(f"Could not share signing keys, fetching directly: {error}")
+        return _fetched_keys()
+
+
+def _refresh_jwks(kid=None):
+    """Bring the held keys up to date, one fetch per process at a time.
+
+    With `kid`, a request is waiting for that key. It waits for a fetch
+    already under way rather than starting another, and does not fetch if that
+    one brought the key or if the last attempt was under JWKS_MIN_REFRESH
+    seconds ago. Without, it is the background refresher, which never waits
+    and skips keys that are not yet due.
+    """
+    if not _jwks_fetching.acquire(blocking=kid is not None):
+        return
+    try:
+        with _jwks_lock:
+            now = time.time()
+            if kid is not None:
+                attempted = _jwks['attempted_at']
+                if kid in _jwks['keys'] or (attempted and now - attempted < JWKS_MIN_REFRESH):
+                    return
+            elif _jwks['fetched_at'] and now - _jwks['fetched_at'] < JWKS_TTL * JWKS_REFRESH_AHEAD:
+                return
+            _jwks['attempted_at'] = now
+
+        loaded = _load_jwks(kid)
+        if loaded:
+            keys, fetched_at = loaded
+            with _jwks_lock:
+                _jwks['keys'] = {key['kid']: key for key in keys}
+                _jwks['fetched_at'] = fetched_at
+    finally:
+        _jwks_fetching.release()
+
+
+def _refresh_jwks_forever():
+    while True:
+        try:
+            _refresh_jwks()
+        except Exception as error:
+            app.logger.error(f"Signing key refresh failed: {error}", exc_info=True)
+        with _jwks_lock:
+            fetched_at = _jwks['fetched_at']
+        due = fetched_at + JWKS_TTL * JWKS_REFRESH_AHEAD if fetched_at else 0
+        time.sleep(max(due - time.time(), JWKS_MIN_REFRESH))
+
+
+def _start_jwks_refresher():
+    """Start the background refresher in this process if it is not running.
+    Checked by process id, since a forked worker inherits the flag but not the
+    thread."""
+    with _jwks_lock:
+        if _jwks['refresher_pid'] == os.getpid():
+            return
+        _jwks['refresher_pid'] = os.getpid()
+    threading.Thread(target=_refresh_jwks_forever, name='jwks-refresher', daemon=True).start()
+
+
+def _signing_key(kid):
+    """The published key with this id, or None."""
+    _start_jwks_refresher()
+    with _jwks_lock:
+        key = _jwks['keys'].get(kid)
+    if key is None:
+        _refresh_jwks(kid)
+        with _jwks_lock:
+            key = _jwks['keys'].get(kid)
+    return key
+
+
+# Verified tokens
+#
+# Clients send the same bearer token for as long as it lasts -- a phone
+# studying sends it hundreds of times an hour -- and checking its RS256
+# signature is by far the most expensive part of authenticating a request.
+# Once a token has verified, its claims are kept until it expires, keyed by a
+# hash of the token so the cache never holds a usable credential.
+
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+_verified_tokens = _LRUCache(TOKEN_CACHE_SIZE, name='tokens')
+
+
+def _verify_token(token):
+    """The claims of a valid access token. Raises AuthError otherwise."""
+    cache_key = hashlib.sha256(token.encode()).digest()
+    payload = _verified_tokens.get(cache_key)
+    if payload is not None:
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Unable to parse authentication"
+                             " token."}, 401)
+    key = _signing_key(unverified_header.get("kid"))
+    rsa_key = {}
+    if key:
+        rsa_key = {
+            "kty": key["kty"],
+            "kid": key["kid"],
+            "use": key["use"],
+            "n": key["n"],
+            "e": key["e"]
+        }
+    if not rsa_key:
+        raise AuthError({"code": "invalid_header",
+                         "description": "Unable to find appropriate key"}, 401)
+    try:
+        payload = jwt.decode(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer="https://" + AUTH0_DOMAIN + "/"
+        )
+    except jwt.ExpiredSignatureError:
+        raise AuthError({"code": "token_expired",
+                         "description": "token is expired"}, 401)
+    except jwt.JWTClaimsError:
+        raise AuthError({"code": "invalid_claims",
+                         "description":
+                             "incorrect claims,"
+                             "please check the audience and issuer"}, 401)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                         "description":
+                             "Unable to parse authentication"
+                             " token."}, 401)
+
+    # A token without an expiry is never cached: nothing would end it.
+    if isinstance(payload.get("exp"), (int, float)):
+        _verified_tokens.set(cache_key, payload, expires_at=payload["exp"])
+    return payload
+
+
+def requires_auth(f):
+    """Determines if the Access Token is valid
+    """
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        request.current_user = _verify_token(get_token_auth_header())
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+# Request identity
+#
+# Endpoints name the account they act on with a `token` field or an `email`
+# parameter, which on its own proves nothing and cannot be trusted to key a
+# cache or a rate limit. A request that carries an access token is attributed
+# from its verified claims instead, and may only act on that account. Requests
+# without one are taken at their word, as before, so existing clients keep
+# working.
+#
+# Auth0 access tokens identify a person by `sub`; the email is in a custom
+# claim when the tenant adds one, and otherwise has to be asked for at
+# /userinfo. Either way it is remembered per subject, so that costs one call
+# per person rather than one per request.
+
+EMAIL_CLAIM = os.environ.get('AUTH0_EMAIL_CLAIM', 'https://recallcards.net/email')
+SUBJECT_EMAIL_TTL = 24 * 60 * 60
+_subject_emails = _LRUCache(TOKEN_CACHE_SIZE, name='subject_emails')
+
+
+def _email_for(claims, token):
+    """The email a verified token belongs to, or None if it cannot be told."""
+    for claim in (EMAIL_CLAIM, 'email'):
+        if claims.get(claim):
+            return claims[claim]
+
+    subject = claims.get('sub')
+    email = _subject_emails.get(subject)
+    if email:
+        return email
+    try:
+        userinfo = Request(f"https://{AUTH0_DOMAIN}/userinfo",
+                           headers={"Authorization": f"Bearer {token}"})
+        with urlopen(userinfo, timeout=5) as response:
+            email = json.loads(response.read()).get('email')
+    except Exception as error:
+        app.logger.warning(f"Could not look up the email for {subject}: {error}")
+        return None
+    if email:
+        _subject_emails.set(subject, email, expires_at=time.time() + SUBJECT_EMAIL_TTL)
+    return email
+
+
+def _request_identity():
+    """The verified email of whoever sent this request, or None if it came
+    without an access token. Worked out once per request."""
+    if 'identity' not in g:
+        identity = None
+        if request.headers.get("Authorization"):
+            token = get_token_auth_header()
+            request.current_user = _verify_token(token)
+            identity = _email_for(request.current_user, token)
+            if not identity:
+                raise AuthError({"code": "unknown_identity",
+                                 "description":
+                                     "Unable to tell which account"
+                                     " this token belongs to."}, 401)
+        g.identity = identity
+    return g.identity
+
+
+def _account_email(claimed):
+    """The account a request acts on: the one it names, which an access token
+    -- if the request has one -- has to agree with."""
+    identity = _request_identity()
+    if identity is None:
+        return claimed
+    if claimed and claimed != identity:
+        raise AuthError({"code": "forbidden",
+                         "description":
+                             "This token does not belong to"
+                             " that account."}, 403)
+    return identity
+
+
+# Conditional reads
+#
+# Clients poll the deck, deck list, stats, progress and share endpoints
+# whether or not anything has changed, and mostly nothing has. Those responses
+# carry an ETag worked out from revisions alone: the account's, which every
+# write to it moves on, and for a followed or shared deck the share's and its
+# owner's. A request whose If-None-Match still matches is answered 304 after a
+# projected read of those, before any cards are loaded.
+#
+# Contributors' display names are not part of the tag, so a deck already held
+# by a client shows a changed name only after its next change.
+#
+# The revisions read for a tag are what the body must be built from, too. A
+# copy of the document cached before another worker's write would otherwise
+# be sent under the tag of that write, and answered 304 ever after, so the
+# request then takes no copy older than the revision it read.
+
+def _expect_revision(email, revision):
+    """Have this request load nothing of `email` older than `revision`."""
+    if has_request_context():
+        g.setdefault('expected_revisions', {})[email] = revision
+
+
+def _expected_revision(email):
+    if not has_request_context():
+        return None
+    return g.get('expected_revisions', {}).get(email)
+
+
+def _account_state(email):
+    """An account's revision and the decks it follows, as {name: share_id},
+    read without any of its cards. None if there is no such account.
+
+    Answered from the user cache where it can be, like a load: what is held
+    of the account, if it is current, or that there is no such account. The
+    rest of the request is then served nothing older than that revision.
+    """
+    entry, held = _cached_user(email, 'state', 'outline')
+    if held is _ABSENT:
+        return None
+    if held is not None and held.get('outline'):
+        held = {'revision': held.get('revision', 0),
+                'links': [[name, link.get('share_id')]
+                          for name, link in (held.get('linked_collections') or {}).items()]}
+    if held is None:
+        found = list(flashcards_collection.aggregate([
+            {'$match': {'user_email': email}},
+            {'$limit': 1},
+            {'$project': {'_id': 0, 'revision': 1, 'escaped_keys': 1, 'links': {'$map': {
+                'input': {'$objectToArray': {'$ifNull': ['$linked_collections', {}]}},
+                'in': {'name': '$$this.k', 'share_id': '$$this.v.share_id'},
+            }}}},
+        ]))
+        if not found:
+            _keep_absent(email, entry)
+            return None
+        stored = found[0]
+        unescape = _unescape_key if stored.get('escaped_keys') else (lambda key: key)
+        # Names as a list of pairs: a decoded one may hold a dot.
+        held = {'revision': stored.get('revision', 0),
+                'links': [[unescape(link['name']), link.get('share_id')]
+                          for link in stored.get('links') or []]}
+        _keep_user(email, entry, 'state', held)
+    _expect_revision(email, held['revision'])
+    return {'revision': held['revision'], 'links': dict(held['links'])}
+
+
+def _revisions(emails):
+    """The revision of each account in `emails` that exists, keyed by email."""
+    states = {email: _account_state(email) for email in dict.fromkeys(emails)}
+    return {email: state['revision'] for email, state in states.items() if state is not None}
+
+
+def _shares_state(share_ids):
+    """What responses built from the decks behind `share_ids` depend on: each
+    share as it stands, and its owner's revision."""
+    shares = _find_shares(share_ids)
+    owners = _revisions(share['owner_email'] for share in shares.values())
+    return sorted([share_id, share['owner_email'], share['collection_name'],
+                   bool(share.get('allow_edit')), share.get('owner_name'),
+                   owners.get(share['owner_email'])]
+                  for share_id, share in shares.items())
+
 
-    if parts[0].lower() != "bearer":
-        raise AuthError({"code": "invalid_header",
-                         "description":
-                             "Authorization header must start with"
-                             " Bearer"}, 401)
-    elif len(parts) == 1:
-        raise AuthError({"code": "invalid_header",
-                         "description": "Token not found"}, 401)
-    elif len(parts) > 2:
-        raise AuthError({"code": "invalid_header",
-                         "description":
-                             "Authorization header must be"
-                             " Bearer token"}, 401)
+def _etag(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str, separators=(',', ':')).encode()).hexdigest()
 
-    token = parts[1]
-    return token
 
+def _conditional(tag_parts):
+    """Tag a read's responses, and answer 304 for one the client already has.
 
-def requires_auth(f):
-    """Determines if the Access Token is valid
+    `tag_parts` is called with the view's arguments and returns what the
+    response depends on, or None to serve the view as it is.
     """
+    def decorate(view):
+        @wraps(view)
+        def conditional(*args, **kwargs):
+            parts = tag_parts(*args, **kwargs) if flashcards_collection is not None else None
+            if parts is None:
+                return view(*args, **kwargs)
+            tag = _etag(request.path, request.args.to_dict(flat=False), _stream_format(), *parts)
+            if request.if_none_match.contains_weak(tag):
+                response = Response(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag)
+            # Per account, and to be checked again on every use.
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Accept')
+            return response
+        return conditional
+    return decorate
+
+
+def _collections_tag(token):
+    state = _account_state(_account_email(token))
+    return [state['revision']] if state is not None else None
+
+
+def _stats_tag(token):
+    state = _account_state(_account_email(token))
+    if state is None:
+        return None
+    return [state['revision'], _shares_state(state['links'].values())]
 
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = get_token_auth_header()
-        jsonurl = urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
-        unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
-        if rsa_key:
-            try:
-                payload = jwt.decode(
-                    token,
-                    rsa_key,
-                    algorithms=ALGORITHMS,
-                    audience=API_AUDIENCE,
-                    issuer="https://" + AUTH0_DOMAIN + "/"
-                )
-            except jwt.ExpiredSignatureError:
-                raise AuthError({"code": "token_expired",
-                                 "description": "token is expired"}, 401)
-            except jwt.JWTClaimsError:
-                raise AuthError({"code": "invalid_claims",
-                                 "description":
-                                     "incorrect claims,"
-                                     "please check the audience and issuer"}, 401)
-            except Exception:
-                raise AuthError({"code": "invalid_header",
-                                 "description":
-                                     "Unable to parse authentication"
-                                     " token."}, 401)
 
-            request.current_user = payload
-            return f(*args, **kwargs)
-        raise AuthError({"code": "invalid_header",
-                         "description": "Unable to find appropriate key"}, 401)
+def _deck_tag():
+    email = _account_email(request.args.get('email'))
+    state = _account_state(email) if email else None
+    if state is None:
+        return None
+    share_id = state['links'].get(request.args.get('collection', 'Default'))
+    return [email, state['revision'], _shares_state([share_id])]
+
+
+def _share_tag(share_id):
+    state = _shares_state([share_id])
+    return state or None
 
-    return decorated
+
+# Streaming
+#
+# A response listing a deck used to be built whole -- a payload for every
+# card, then one string of all of them -- before its first byte went out, so a
+# big deck was held several times over at once. Asked to, the endpoints that
+# list cards send them as they are produced instead: `stream=1` for the same
+# JSON, or NDJSON -- `format=ndjson`, or `Accept: application/x-ndjson` -- for
+# the rest of the response on its first line and then one card per line.
+# Cards kept in the cards collection are read from MongoDB as they are sent,
+# so memory stays flat however big the deck. The status goes out before the
+# cards are read, so a failure part way through cuts the response short
+# rather than turning it into a 500.
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def _stream_format():
+    """How the caller asked for a listing to be streamed: 'ndjson', 'json', or
+    None for a response built whole."""
+    accepted = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    if request.args.get('format') == 'ndjson' or accepted == NDJSON_MIMETYPE:
+        return 'ndjson'
+    if request.args.get('stream') in ('1', 'true'):
+        return 'json'
+    return None
+
+
+def _chunked(pieces):
+    """`pieces` of encoded JSON joined into chunks of about
+    STREAM_CHUNK_BYTES, so a card does not cost a write to the socket of its
+    own."""
+    chunk, size = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def _streamed(stream_format, body, key, items):
+    """A response of `body` with `items` as its `key`, encoded an item at a
+    time: the JSON _json_response() would make of it, or NDJSON."""
+    if stream_format == 'ndjson':
+        def pieces():
+            yield _json_dumps({name: value for name, value in body.items() if name != key}) + b'\n'
+            for item in items:
+                yield _json_dumps(item) + b'\n'
+        return Response(stream_with_context(_chunked(pieces())), mimetype=NDJSON_MIMETYPE)
+
+    # The rest of the body is encoded around a placeholder, and the items
+    # written where it was.
+    placeholder = f'@{secrets.token_hex(8)}'
+    head, tail = _json_dumps({**body, key: placeholder}).split(_json_dumps(placeholder))
+
+    def pieces():
+        yield head + b'['
+        separator = b''
+        for item in items:
+            yield separator + _json_dumps(item)
+            separator = b','
+        yield b']' + tail
+    return Response(stream_with_context(_chunked(pieces())), mimetype='application/json')
+
+
+def _iter_owned_deck(user_doc, collection_name, fields=None):
+    """(term, card) for each card of an owned deck, in deck order, with enough
+    of each to show `fields`. Cards in the cards collection are read as they
+    are asked for, not all at once."""
+    if not _cards_in_collection(user_doc):
+        yield from (_owned_deck(user_doc, collection_name) or {}).items()
+        return
+    documents = cards_collection.find({'user_email': user_doc['user_email'], 'collection': collection_name},
+                                      _stored_card_projection(fields))
+    for doc in documents.sort('_id', 1):
+        yield doc.pop('term'), doc
 
 
 @app.route('/api/words', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
 def allwords():
     if flashcards_collection is None:
-        return Response(json.dumps({}), mimetype='application/json')
+        return _json_response({})
 
     # Scoped to a single user. This used to iterate the whole collection and
     # return every account's cards to any caller.
-    email = request.args.get('email')
+    email = _account_email(request.args.get('email'))
     if not email:
-        return jsonify({"status": 400, "error": "email query parameter is required"}), 400
-
-    user_doc = flashcards_collection.find_one({'user_email': email})
+        return _json_response({"status": 400, "error": "email query parameter is required"}), 400
+
+    stream = _stream_format()
+    user_doc = _load_user(email)
+    if stream == 'ndjson':
+        return _streamed(stream, {'email': email, 'cards': None}, 'cards', (
+            {'collection': name, 'term': term, 'value': _legacy_value(_normalise_card(card))}
+            for name in (migrate_user_to_collections(user_doc) if user_doc else [])
+            for term, card in _iter_owned_deck(user_doc, name)))
     if not user_doc:
-        return Response(json.dumps({}), mimetype='application/json')
+        return _json_response({})
+
+    if stream:
+        return Response(stream_with_context(_chunked(_legacy_pieces(email, user_doc))),
+                        mimetype='application/json')
 
-    collections = migrate_user_to_collections(user_doc)
     legacy = {
         name: {term: _legacy_value(card) for term, card in cards.items()}
-        for name, cards in collections.items()
+        for name, cards in _owned_decks(user_doc).items()
     }
-    return Response(json.dumps({email: legacy}), mimetype='application/json')
+    return _json_response({email: legacy})
+
+
+def _legacy_pieces(email, user_doc):
+    """allwords' response, written a card at a time."""
+    yield b'{' + _json_dumps(email) + b':{'
+    for index, name in enumerate(list(migrate_user_to_collections(user_doc))):
+        yield (b',' if index else b'') + _json_dumps(name) + b':{'
+        separator = b''
+        for term, card in _iter_owned_deck(user_doc, name):
+            yield separator + _json_dumps(term) + b':' + _json_dumps(_legacy_value(_normalise_card(card)))
+            separator = b','
+        yield b'}'
+    yield b'}}'
 
 
 @app.route('/api/words/rand/<token>', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
 def getwordrand(token):
+    token = _account_email(token)
     if flashcards_collection is None:
-        return json.dumps(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
+        return _json_response(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
     
     # Get collection from query parameter, default to 'Default'
     collection_name = request.args.get('collection', 'Default')
     # Get index from query parameter (0-based)
     index = request.args.get('index', None)
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
-        return json.dumps(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
-    
-    # Migrate if needed
-    collections = migrate_user_to_collections(user_doc)
+        return _json_response(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
     
     # Get cards from the specified collection
-    if collection_name not in collections or len(collections[collection_name]) == 0:
-        return json.dumps(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
+    cards = _owned_deck(user_doc, collection_name)
+    if not cards:
+        return _json_response(["You Don't Have Anything to Memorize ", "Please Add Cards!"])
     
-    cards = collections[collection_name]
     # Convert to list to maintain insertion order (Python 3.7+ dicts maintain order)
     cards_list = [(term, _legacy_value(card)) for term, card in cards.items()]
 
@@ -367,30 +2387,36 @@ def getwordrand(token):
         except ValueError:
             pass
 
-    return json.dumps(list(cards_list[position]))
+    return _json_response(list(cards_list[position]))
 
 
 @app.route('/api/sendwords', methods=['POST'])
 @cross_origin(headers=["Content-Type", "Authorization"])
 def send_word():
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"})
+        return _json_response({"status": 500, "error": "Database not connected"})
     
     data = request.get_json(silent=True)
     if not data or 'token' not in data or 'word' not in data or 'ans' not in data:
-        return jsonify({"status": 400, "error": "Missing required fields"})
+        return _json_response({"status": 400, "error": "Missing required fields"})
     
-    token = data['token']
+    token = _account_email(data['token'])
     word = data['word']
     ans = data['ans']
     image_id = data.get('image') or None
     collection_name = data.get('collection', 'Default')  # Default collection if not specified
 
+    # Cards are stored under their deck and term, and an empty one of either
+    # has no field path.
+    if not word:
+        return _json_response({"status": 400, "error": "A term is required"})
+    if not collection_name:
+        return _json_response({"status": 400, "error": "Collection name cannot be empty"})
     # A card needs something on the back, but that something may be a picture.
     if not str(ans).strip() and not image_id:
-        return jsonify({"status": 400, "error": "A definition or an image is required"})
+        return _json_response({"status": 400, "error": "A definition or an image is required"})
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
 
     # A deck the caller follows is written through its share, so the card lands
     # in the one deck everyone with the link is reading.
@@ -398,11 +2424,11 @@ def send_word():
     if error:
         return error
     if share:
-        _, source = _shared_source(share)
+        owner_doc, source = _shared_source(share)
         if source is None:
-            return jsonify({"status": 404, "error": "That shared deck is no longer available"}), 404
+            return _json_response({"status": 404, "error": "That shared deck is no longer available"}), 404
         if word not in source and len(source) >= MAX_SHARED_DECK_CARDS:
-            return jsonify({"status": 400,
+            return _json_response({"status": 400,
                             "error": f"This deck has reached {MAX_SHARED_DECK_CARDS} cards."})
         existing = source.get(word)
         card = _normalise_card(existing) if existing else _default_card(ans)
@@ -410,8 +2436,7 @@ def send_word():
         if image_id:
             card['image'] = image_id
         _stamp_edited(card, token) if existing else _stamp_created(card, token)
-        source[word] = card
-        _write_shared_card(share, {share['collection_name']: source}, word, card)
+        _write_shared_card(share, owner_doc, word, card, previous=existing)
         return {"status": 200}
 
     if not user_doc:
@@ -419,23 +2444,13 @@ def send_word():
         new_card = _default_card(ans)
         new_card['image'] = image_id
         _stamp_created(new_card, token)
-        collections = {collection_name: {word: new_card}}
-        flashcards_collection.insert_one({
-            'user_email': token,
-            'collections': collections,
-            'default_collection': collection_name,
-            'created_at': datetime.utcnow()
-        })
+        if not _insert_user(token, collection_name, {collection_name: {word: new_card}}):
+            # Created by another request meanwhile; add the card to it.
+            return send_word()
     else:
-        # Migrate if needed
-        collections = migrate_user_to_collections(user_doc)
-
-        # Initialize collection if it doesn't exist
-        if collection_name not in collections:
-            collections[collection_name] = {}
-
-        # Add or update the word, keeping any review history it already has
-        existing = collections[collection_name].get(word)
+        # Add or update the word, keeping any review history it already has.
+        # A collection that does not exist yet is created by writing to it.
+        existing = _owned_card(user_doc, collection_name, word)
         card = _normalise_card(existing) if existing else _default_card(ans)
         card['definition'] = ans
         _stamp_edited(card, token) if existing else _stamp_created(card, token)
@@ -445,11 +2460,7 @@ def send_word():
             if card.get('image') and card['image'] != image_id:
                 _delete_image(card['image'])
             card['image'] = image_id
-        collections[collection_name][word] = card
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}}
-        )
+        _write_card(user_doc, collection_name, word, card, previous=existing)
     
     return {"status": 200}
 
@@ -465,22 +2476,24 @@ def send_token():
 @cross_origin(headers=["Content-Type", "Authorization"])
 def del_word(word):
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"})
+        return _json_response({"status": 500, "error": "Database not connected"})
     
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"})
+        return _json_response({"status": 400, "error": "Missing token in request body"})
     
-    token = data['token']
+    token = _account_email(data['token'])
     collection_name = data.get('collection', 'Default')
+    if not collection_name:
+        return _json_response({"status": 400, "error": "Collection name cannot be empty"})
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"})
+        return _json_response({"status": 404, "error": "User not found"})
 
     # Deleting from a followed deck is the owner's alone; see the sharing note.
     if collection_name in _linked_collections(user_doc):
-        return jsonify({
+        return _json_response({
             "status": 403,
             "error": "Only the owner can delete cards from a shared deck.",
         }), 403
@@ -488,81 +2501,72 @@ def del_word(word):
     # Migrate if needed
     collections = migrate_user_to_collections(user_doc)
 
-    # Initialize collection if it doesn't exist
     if collection_name not in collections:
-        return jsonify({"status": 404, "error": "Collection not found"})
+        return _json_response({"status": 404, "error": "Collection not found"})
     
-    cards = collections[collection_name]
-    if word in cards:
-        _delete_image(_normalise_card(cards[word]).get('image'))
-        del cards[word]
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}}
-        )
-        return jsonify({"status": 200})
+    card = _owned_card(user_doc, collection_name, word)
+    # Another request may delete it first, and is the one to say so.
+    if card is not None and _delete_card(user_doc, collection_name, word, card):
+        _delete_image(_normalise_card(card).get('image'))
+        return _json_response({"status": 200})
     else:
-        return jsonify({"status": 404, "error": "Word not found"})
+        return _json_response({"status": 404, "error": "Word not found"})
 
 
 @app.route('/api/editword', methods=['POST'])
 @cross_origin(headers=["Content-Type", "Authorization"])
 def edit_word():
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"})
+        return _json_response({"status": 500, "error": "Database not connected"})
     
     data = request.get_json(silent=True)
     if not data or 'token' not in data or 'oldword' not in data or 'word' not in data or 'ans' not in data:
-        return jsonify({"status": 400, "error": "Missing required fields"})
+        return _json_response({"status": 400, "error": "Missing required fields"})
     
-    token = data['token']
+    token = _account_email(data['token'])
     oldWord = data['oldword']
     word = data['word']
     ans = data['ans']
     collection_name = data.get('collection', 'Default')
+
+    # As for send_word: no field path has an empty name.
+    if not word:
+        return _json_response({"status": 400, "error": "A term is required"})
+    if not collection_name:
+        return _json_response({"status": 400, "error": "Collection name cannot be empty"})
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"})
+        return _json_response({"status": 404, "error": "User not found"})
 
     # Same for edits: a followed deck is edited through its share.
     share, error = _followed_write_target(user_doc, token, collection_name)
     if error:
         return error
     if share:
-        _, shared = _shared_source(share)
+        owner_doc, shared = _shared_source(share)
         if shared is None:
-            return jsonify({"status": 404, "error": "That shared deck is no longer available"}), 404
+            return _json_response({"status": 404, "error": "That shared deck is no longer available"}), 404
         origin = word if word in shared else oldWord
         if origin not in shared:
-            return jsonify({"status": 404, "error": "Word not found"})
+            return _json_response({"status": 404, "error": "Word not found"})
         card = _normalise_card(shared[origin])
         card['definition'] = _normalise_card(ans)['definition']
         _stamp_edited(card, token)
         if 'image' in data:
             card['image'] = data.get('image') or None
-        if word != origin:
-            del shared[origin]
-        shared[word] = card
-        _write_shared_card(share, {share['collection_name']: shared}, word,
-                           card, replaced_term=origin)
-        return jsonify({"status": 200})
-
-    # Migrate if needed
-    collections = migrate_user_to_collections(user_doc)
-
-    # Initialize collection if it doesn't exist
-    if collection_name not in collections:
-        collections[collection_name] = {}
-
-    cards = collections[collection_name]
+        _write_shared_card(share, owner_doc, word, card, replaced_term=origin,
+                           previous=shared[origin])
+        return _json_response({"status": 200})
 
-    source = word if word in cards else oldWord
-    if source not in cards:
-        return jsonify({"status": 404, "error": "Word not found"})
+    source, stored = word, _owned_card(user_doc, collection_name, word)
+    if stored is None:
+        source, stored = oldWord, _owned_card(user_doc, collection_name, oldWord)
+    if stored is None:
+        return _json_response({"status": 404, "error": "Word not found"})
 
     incoming = _normalise_card(ans)
-    card = _normalise_card(cards[source])
+    card = _normalise_card(stored)
     card['definition'] = incoming['definition']
     _stamp_edited(card, token)
 
@@ -582,81 +2586,127 @@ def edit_word():
         # Older clients flag a card by appending the sentinel to the definition.
         card['needs_review'] = True
 
-    if source != word:
-        del cards[source]
-    cards[word] = card
-
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}}
-    )
-    return jsonify({"status": 200})
+    _write_card(user_doc, collection_name, word, card, replaced_term=source, previous=stored)
+    return _json_response({"status": 200})
 
 
 # Collections API endpoints
-def migrate_user_to_collections(user_doc):
-    """Bring a user document up to the current shape.
+#
+# Document shape
+#
+# `schema_version` records that a user document is in the current shape: every
+# deck under `collections`, every card a structured document. Reading one that
+# is current costs nothing, which matters because every endpoint reads the
+# account. Documents from before are brought up to date in pieces: the deck
+# map on first read, then each deck's cards the first time that deck is read,
+# with `normalised_decks` listing the decks done so far. Once all of them are,
+# the document is stamped and the list dropped.
+#
+# Raise SCHEMA_VERSION whenever the stored card shape changes, so documents
+# written before are normalised again.
+SCHEMA_VERSION = 1
 
-    Handles both migrations: the old top-level 'cards' dict into 'collections',
-    and bare definition strings into structured card documents. Rewrites the
-    document only when something actually changed.
-    """
-    had_legacy_cards = 'cards' in user_doc and 'collections' not in user_doc
 
-    if had_legacy_cards:
-        collections = {'Default': user_doc['cards']}
-    elif 'collections' in user_doc:
-        collections = user_doc['collections']
-    else:
-        collections = {'Default': {}}
+def _is_current(user_doc):
+    return user_doc.get('schema_version') == SCHEMA_VERSION
 
-    normalised = {
-        name: {term: _normalise_card(value) for term, value in cards.items()}
-        for name, cards in collections.items()
-    }
 
-    if normalised != collections or had_legacy_cards or 'default_collection' not in user_doc:
+def _stamp_if_current(user_doc, collections):
+    """Record that the document is current once every deck in it is."""
+    done = user_doc.get('normalised_decks') or []
+    if any(name not in done for name in collections):
+        return
+    _update_user(user_doc['user_email'],
+                 {'$set': {'schema_version': SCHEMA_VERSION}, '$unset': {'normalised_decks': ''}})
+    user_doc['schema_version'] = SCHEMA_VERSION
+    user_doc.pop('normalised_decks', None)
+
+
+def _stored_decks(user_doc):
+    """The deck map of a document in any shape, and whether it came from the
+    old top-level 'cards' dict."""
+    if 'cards' in user_doc and 'collections' not in user_doc:
+        return {'Default': user_doc['cards']}, True
+    if 'collections' in user_doc:
+        return user_doc['collections'], False
+    return {'Default': {}}, False
+
+
+def migrate_user_to_collections(user_doc):
+    """Bring a user document's deck map up to the current shape, returning it.
+
+    Moves the old top-level 'cards' dict into 'collections'. Cards themselves
+    are normalised a deck at a time by _current_deck(). Rewrites the document
+    only when something actually changed.
+    """
+    if _is_current(user_doc):
+        return user_doc['collections']
+
+    collections, had_legacy_cards = _stored_decks(user_doc)
+    if had_legacy_cards or 'collections' not in user_doc or 'default_collection' not in user_doc:
         update = {'$set': {
-            'collections': normalised,
+            'collections': _escaped_collections(collections),
             'default_collection': user_doc.get('default_collection', 'Default'),
         }}
         if had_legacy_cards:
             update['$unset'] = {'cards': ''}
 
-        flashcards_collection.update_one(
-            {'user_email': user_doc['user_email']}, update, upsert=True
-        )
+        _update_user(user_doc['user_email'], update, upsert=True)
+        user_doc.setdefault('default_collection', 'Default')
 
-    user_doc['collections'] = normalised
+    user_doc['collections'] = collections
     user_doc.pop('cards', None)
+    _stamp_if_current(user_doc, collections)
+    return collections
+
+
+def _current_deck(user_doc, collection_name):
+    """The cards of a deck kept in the user document, normalised first if the
+    document predates the current shape. None if there is no such deck."""
+    collections = migrate_user_to_collections(user_doc)
+    cards = collections.get(collection_name)
+    if cards is None or _is_current(user_doc):
+        return cards
+    done = user_doc.setdefault('normalised_decks', [])
+    if collection_name in done:
+        return cards
+
+    normalised = {term: _normalise_card(value) for term, value in cards.items()}
+    update = {'$addToSet': {'normalised_decks': collection_name}}
+    if normalised != cards:
+        update['$set'] = {_collection_field_path(collection_name): _escaped_cards(normalised)}
+    _update_user(user_doc['user_email'], update, match={'card_store': {'$exists': False}})
+
+    collections[collection_name] = normalised
+    done.append(collection_name)
+    _stamp_if_current(user_doc, collections)
     return normalised
 
 
 @app.route('/api/collections/<token>', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
+@_conditional(_collections_tag)
 def get_collections(token):
     """Get all collections for a user"""
+    token = _account_email(token)
     if flashcards_collection is None:
         return {"status": 500, "error": "Database not connected"}
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
         # Return empty structure for new users
         # Same shape as the populated response, so a client never has to
         # special-case a brand-new account.
-        return Response(json.dumps({
+        return _json_response({
             'collections': ['Default'],
             'default_collection': 'Default',
             'covers': {'Default': None},
             'linked': [],
-        }), mimetype='application/json')
+        })
     
-    # Migrate if needed
+    # Migrate if needed; this brings user_doc itself up to date as well.
     collections = migrate_user_to_collections(user_doc)
     
-    # Refresh user_doc to get updated structure
-    user_doc = flashcards_collection.find_one({'user_email': token})
-    
     collection_names = list(collections.keys())
     # Decks followed through a share link sit alongside owned ones, so every
     # client lists them without knowing they are shared.
@@ -667,14 +2717,14 @@ def get_collections(token):
     # deck, so present the same starting point a brand-new user gets.
     if not collection_names:
         collection_names = ['Default']
-    default_collection = user_doc.get('default_collection', 'Default') if user_doc else 'Default'
+    default_collection = user_doc.get('default_collection', 'Default')
     
-    return Response(json.dumps({
+    return _json_response({
         'collections': collection_names,
         'default_collection': default_collection,
         'covers': _covers_map(user_doc, collection_names),
         'linked': list(linked.keys()),
-    }), mimetype='application/json')
+    })
 
 
 @app.route('/api/collections', methods=['POST'])
@@ -688,23 +2738,18 @@ def create_collection():
     if not data or 'token' not in data or 'collection_name' not in data:
         return {"status": 400, "error": "Missing required fields"}
     
-    token = data['token']
+    token = _account_email(data['token'])
     collection_name = data['collection_name'].strip()
     
     if not collection_name:
         return {"status": 400, "error": "Collection name cannot be empty"}
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     
     if not user_doc:
         # Create new user with the collection
-        collections = {collection_name: {}}
-        flashcards_collection.insert_one({
-            'user_email': token,
-            'collections': collections,
-            'default_collection': collection_name,
-            'created_at': datetime.utcnow()
-        })
+        if not _insert_user(token, collection_name, {collection_name: {}}):
+            return create_collection()
     else:
         # Migrate if needed
         collections = migrate_user_to_collections(user_doc)
@@ -712,11 +2757,7 @@ def create_collection():
         if collection_name in collections:
             return {"status": 400, "error": "Collection already exists"}
         
-        collections[collection_name] = {}
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}}
-        )
+        _write_collection(user_doc, collection_name, {})
     
     return {"status": 200}
 
@@ -732,23 +2773,22 @@ def delete_collection(collection_name):
     if not data or 'token' not in data:
         return {"status": 400, "error": "Missing token in request body"}
     
-    token = data['token']
+    token = _account_email(data['token'])
     
     if collection_name == 'Default':
         return {"status": 400, "error": "Cannot delete Default collection"}
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
         return {"status": 404, "error": "User not found"}
 
     # "Delete" on a followed deck means stop following: it is not the caller's
     # deck to delete, and the owner's copy must survive.
-    links = dict(_linked_collections(user_doc))
-    if collection_name in links:
-        del links[collection_name]
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'linked_collections': links, 'updated_at': datetime.utcnow()}},
+    if collection_name in _linked_collections(user_doc):
+        _update_user(
+            token,
+            {'$unset': {_link_field_path(collection_name): ""},
+             '$set': {'updated_at': datetime.utcnow()}},
         )
         return {"status": 200}
 
@@ -760,27 +2800,21 @@ def delete_collection(collection_name):
     
     # Delete the collection, the pictures its cards referred to, and any share
     # link pointing at it -- the link would otherwise 404 forever.
-    for image_id in _card_image_ids(collections[collection_name]):
+    for image_id in _card_image_ids(_owned_deck(user_doc, collection_name)):
         _delete_image(image_id)
     if shares_collection is not None:
+        revoked = _share_ids_for(token, collection_name)
         shares_collection.delete_many({'owner_email': token, 'collection_name': collection_name})
+        _forget_shares(revoked)
 
-    meta = dict(_collection_meta(user_doc))
-    _delete_image(meta.get(collection_name, {}).get('cover_image'))
-    meta.pop(collection_name, None)
-
-    del collections[collection_name]
+    _delete_image(_cover_of(user_doc, collection_name))
     
     # If it was the default collection, set Default as default
     default_collection = user_doc.get('default_collection', 'Default')
     if default_collection == collection_name:
         default_collection = 'Default'
     
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'collections': collections, 'default_collection': default_collection,
-                  'collection_meta': meta, 'updated_at': datetime.utcnow()}}
-    )
+    _drop_collection(user_doc, collection_name, default_collection)
 
     return {"status": 200}
 
@@ -796,10 +2830,10 @@ def set_default_collection():
     if not data or 'token' not in data or 'collection_name' not in data:
         return {"status": 400, "error": "Missing required fields"}
     
-    token = data['token']
+    token = _account_email(data['token'])
     collection_name = data['collection_name']
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
         return {"status": 404, "error": "User not found"}
     
@@ -809,8 +2843,8 @@ def set_default_collection():
     if collection_name not in collections:
         return {"status": 404, "error": "Collection not found"}
     
-    flashcards_collection.update_one(
-        {'user_email': token},
+    _update_user(
+        token,
         {'$set': {'default_collection': collection_name, 'updated_at': datetime.utcnow()}}
     )
     
@@ -828,7 +2862,7 @@ def rename_collection(old_collection_name):
     if not data or 'token' not in data or 'new_collection_name' not in data:
         return {"status": 400, "error": "Missing required fields"}
     
-    token = data['token']
+    token = _account_email(data['token'])
     new_collection_name = data['new_collection_name'].strip()
     
     if not new_collection_name:
@@ -837,7 +2871,7 @@ def rename_collection(old_collection_name):
     if old_collection_name == 'Default':
         return {"status": 400, "error": "Cannot rename Default collection"}
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
         return {"status": 404, "error": "User not found"}
     
@@ -850,112 +2884,351 @@ def rename_collection(old_collection_name):
     if new_collection_name in collections:
         return {"status": 400, "error": "A collection with that name already exists"}
     
-    # Rename the collection
-    collections[new_collection_name] = collections[old_collection_name]
-    del collections[old_collection_name]
-    
     # Update default_collection if it was the renamed collection
     default_collection = user_doc.get('default_collection', 'Default')
     if default_collection == old_collection_name:
         default_collection = new_collection_name
 
-    # Per-deck settings are keyed by name too, so the cover moves with it.
-    meta = dict(_collection_meta(user_doc))
-    if old_collection_name in meta:
-        meta[new_collection_name] = meta.pop(old_collection_name)
-
     # A share link points at a collection by name, so it has to follow the
     # rename or it would resolve to nothing.
     if shares_collection is not None:
+        moved = _share_ids_for(token, old_collection_name)
         shares_collection.update_many(
             {'owner_email': token, 'collection_name': old_collection_name},
             {'$set': {'collection_name': new_collection_name}},
         )
+        _forget_shares(moved)
     
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'collections': collections, 'default_collection': default_collection,
-                  'collection_meta': meta, 'updated_at': datetime.utcnow()}}
-    )
+    _rename_collection(user_doc, old_collection_name, new_collection_name, default_collection)
 
     return {"status": 200}
 
 
 @app.route('/api/collections/<token>/stats', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
+@_conditional(_stats_tag)
 def get_collection_stats(token):
     """Get statistics for all collections (card counts)"""
+    token = _account_email(token)
     if flashcards_collection is None:
         return {"status": 500, "error": "Database not connected"}
     
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user_outline(token)
     if not user_doc:
-        return Response(json.dumps({'stats': {}}), mimetype='application/json')
-    
-    # Migrate if needed
-    collections = migrate_user_to_collections(user_doc)
+        return _json_response({'stats': {}})
     
-    def summarise(cards):
-        """What the deck list needs to answer 'how ready am I?' at a glance."""
-        values = list(cards.values())
-        stamps = [c['last_reviewed'] for c in values if c.get('last_reviewed')]
-        return {
-            'total': len(values),
-            'known': sum(1 for c in values if c['seen'] > 0 and not c['needs_review']),
-            'needs_review': sum(1 for c in values if c['needs_review']),
-            'studied': sum(1 for c in values if c['seen'] > 0),
-            'last_reviewed': max(stamps) if stamps else None,
-        }
-
     stats = {}
     # Per-deck progress in the same response as the counts. The deck list needs
     # it for every deck at once, and one request beats one per deck.
     progress = {}
     owners = {}
 
-    for collection_name, cards in collections.items():
-        stats[collection_name] = len(cards)
-        progress[collection_name] = summarise({t: _normalise_card(v) for t, v in cards.items()})
+    owned = list(migrate_user_to_collections(user_doc))
+    for collection_name, summary in _deck_summaries(user_doc, owned).items():
+        stats[collection_name] = summary['total']
+        progress[collection_name] = _progress_of(summary)
 
-    for name, link in _linked_collections(user_doc).items():
-        followed, _ = _resolve_collection(user_doc, name)
+    # A followed deck's cards change under the follower with nothing on their
+    # account to count them by, so these are still counted as they are read.
+    for name, (followed, share, owner_doc) in _followed_decks(user_doc).items():
+        followed = followed or {}
         stats[name] = len(followed)
-        progress[name] = summarise(followed)
-        share = (shares_collection.find_one({'share_id': link.get('share_id')})
-                 if shares_collection is not None else None)
+        progress[name] = _progress_of(_summary_of(followed))
         if share:
-            owner_doc = flashcards_collection.find_one({'user_email': share['owner_email']})
             owners[name] = _display_name_of(owner_doc) or share.get('owner_name')
     
-    return Response(json.dumps({
+    return _json_response({
         'stats': stats,
         'progress': progress,
         'owners': owners,
-    }), mimetype='application/json')
+    })
+
+
+# Paging
+#
+# A deck of thousands of cards, attributed and with its review history, is a
+# large response to build and to send, and a client listing terms needs little
+# of it. /api/cards takes `limit`, to send a page at a time, and `fields`, to
+# send only some of each card; leaving out the authorship fields skips looking
+# up names altogether.
+#
+# The cursor for the next page holds how many cards came before it, the term
+# of the last of those and the term of the first card of the page. Paging
+# resumes after the one or at the other, so cards added or deleted between
+# pages do not shift it, and falls back on the count only if both have gone.
+
+CARDS_PAGE_MAX = 1000
+CARD_PAYLOAD_FIELDS = ('term', 'definition', 'image', 'seen', 'correct', 'incorrect',
+                       'needs_review', 'last_reviewed', 'created_by_name', 'created_by_you',
+                       'edited_by_name', 'edited_by_you')
+ATTRIBUTION_PAYLOAD_FIELDS = {'created_by_name', 'created_by_you', 'edited_by_name', 'edited_by_you'}
+
+
+def _page_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def _page_position(cursor):
+    """(cards before, last term before, first term) from a page cursor;
+    ValueError if it is not one."""
+    try:
+        served, last, first = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor') from None
+    if not isinstance(served, int) or served < 0 or not all(isinstance(t, str) for t in (last, first)):
+        raise ValueError('Invalid cursor')
+    return served, last, first
+
+
+def _page_args(args):
+    """(limit, position, fields) asked for: limit and position None for the
+    whole deck, fields None for every field. ValueError for a bad one."""
+    limit, position, fields = args.get('limit'), None, args.get('fields')
+    if limit is not None or args.get('after') is not None:
+        try:
+            limit = int(limit) if limit is not None else CARDS_PAGE_MAX
+        except ValueError:
+            raise ValueError('limit must be a number') from None
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        limit = min(limit, CARDS_PAGE_MAX)
+        position = _page_position(args['after']) if args.get('after') else (0, None, None)
+    if fields is not None:
+        fields = {'term', *(field.strip() for field in fields.split(',') if field.strip())}
+        unknown = fields.difference(CARD_PAYLOAD_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return limit, position, fields
+
+
+def _contributors(cards, owner_email):
+    """Everyone who has written or changed a card of `cards`."""
+    contributors = set()
+    for value in cards.values():
+        contributors.update(author for author in _authors(_normalise_card(value), owner_email) if author)
+    return contributors
+
+
+def _wants_attribution(fields):
+    return fields is None or bool(fields & ATTRIBUTION_PAYLOAD_FIELDS)
+
+
+def _stored_card_projection(fields):
+    """What to read of each card document to show `fields` of it."""
+    if fields is None:
+        return _CARD_DOCUMENT_PROJECTION
+    stored = fields - ATTRIBUTION_PAYLOAD_FIELDS
+    if _wants_attribution(fields):
+        stored |= {'created_by', 'edited_by'}
+    return {'_id': 0, **dict.fromkeys(stored, 1)}
+
+
+def _deck_contributors(email, collection_name):
+    """Everyone who has written or changed a card of an owned deck kept in the
+    cards collection, without reading the cards."""
+    authors = next(cards_collection.aggregate([
+        {'$match': {'user_email': email, 'collection': collection_name}},
+        {'$group': {'_id': None,
+                    'creators': {'$addToSet': {'$ifNull': ['$created_by', email]}},
+                    'editors': {'$addToSet': '$edited_by'}}},
+    ]), {})
+    # Someone who edited only their own cards is among the creators already,
+    # so this is the same set _attribute() counts.
+    return {author for author in authors.get('creators', []) + authors.get('editors', []) if author}
+
+
+def _card_payloads(cards, owner_email, viewer_email, names, fields):
+    """The payload of each of `cards` -- a dict, or (term, card) pairs -- one
+    at a time: attributed from `names` unless that is None, and cut down to
+    `fields` unless that is."""
+    for term, value in cards.items() if isinstance(cards, dict) else cards:
+        card = _normalise_card(value)
+        if names is None:
+            payload = _card_payload(term, card)
+        else:
+            payload = _attributed(term, card, *_authors(card, owner_email), viewer_email, names)
+        yield payload if fields is None else {field: payload[field] for field in payload if field in fields}
+
+
+def _collection_page(user_doc, collection_name, position, limit, fields):
+    """The cards of a collection from `position` on -- up to `limit` of them,
+    or all of them for None -- with enough of each to show `fields`.
+
+    Returns (cards, link, contributors, next_position), with link as for
+    _resolve_collection(), contributors for the whole deck when a page of it
+    is shown attributed and None otherwise, and next_position None after the
+    last card. An owned deck in the cards collection is read a page at a time;
+    any other is read whole and sliced.
+    """
+    served, last, first = position or (0, None, None)
+    contributors = None
+    if _cards_in_collection(user_doc) and collection_name in migrate_user_to_collections(user_doc):
+        email = user_doc['user_email']
+        match = {'user_email': email, 'collection': collection_name}
+        projection = _stored_card_projection(fields)
+        documents = None
+        for term, operator in ((last, '$gt'), (first, '$gte')):
+            found = (cards_collection.find_one(_card_key(email, collection_name, term), {'_id': 1})
+                     if term is not None else None)
+            if found is not None:
+                documents = cards_collection.find({**match, '_id': {operator: found['_id']}}, projection)
+                break
+        if documents is None:
+            documents = cards_collection.find(match, projection).skip(served)
+        found = _deck_from_documents(documents.limit(limit + 1) if limit else documents)
+        if limit and _wants_attribution(fields):
+            contributors = _deck_contributors(email, collection_name)
+        link = None
+    else:
+        cards, link = _resolve_collection(user_doc, collection_name)
+        terms = list(cards)
+        if last in cards:
+            start = terms.index(last) + 1
+        elif first in cards:
+            start = terms.index(first)
+        else:
+            start = served
+        found = {term: cards[term] for term in terms[start:start + limit + 1 if limit else None]}
+        if limit and _wants_attribution(fields):
+            contributors = _contributors(cards, _collection_owner(link, user_doc['user_email']))
+
+    if not limit or len(found) <= limit:
+        return found, link, contributors, None
+    terms = list(found)
+    page = {term: found[term] for term in terms[:limit]}
+    return page, link, contributors, (served + limit, terms[limit - 1], terms[limit])
 
 
 @app.route('/api/cards', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
+@_conditional(_deck_tag)
 def get_cards():
-    """Every card in a collection, with its review history."""
+    """The cards in a collection, with their review history: every one, or a
+    page of them, and every field or only those asked for."""
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
-    email = request.args.get('email')
+    email = _account_email(request.args.get('email'))
     if not email:
-        return jsonify({"status": 400, "error": "email query parameter is required"}), 400
+        return _json_response({"status": 400, "error": "email query parameter is required"}), 400
 
     collection_name = request.args.get('collection', 'Default')
+    try:
+        limit, position, fields = _page_args(request.args)
+    except ValueError as error:
+        return _json_response({"status": 400, "error": str(error)}), 400
 
-    user_doc = flashcards_collection.find_one({'user_email': email})
+    stream = _stream_format()
+    user_doc = _load_user_deck(email, collection_name)
     if not user_doc:
-        return Response(json.dumps({'cards': []}), mimetype='application/json')
+        body = {'cards': []}
+        if limit is not None:
+            body['next'] = None
+        if stream:
+            return _streamed(stream, body, 'cards', [])
+        return _json_response(body)
+
+    if (stream and limit is None and _cards_in_collection(user_doc)
+            and collection_name in migrate_user_to_collections(user_doc)):
+        cards, link = _iter_owned_deck(user_doc, collection_name, fields), None
+        contributors = _deck_contributors(email, collection_name) if _wants_attribution(fields) else None
+    elif limit is None and fields is None:
+        cards, link = _resolve_collection(user_doc, collection_name)
+        contributors = None
+    else:
+        cards, link, contributors, following = _collection_page(user_doc, collection_name,
+                                                                position, limit, fields)
+
+    if stream:
+        owner_email = _collection_owner(link, email)
+        body, names = {'cards': None}, None
+        if _wants_attribution(fields):
+            if contributors is None:
+                contributors = _contributors(cards, owner_email)
+            names = _names_for(contributors)
+            body['multi_author'] = len(contributors) > 1
+        if limit is not None:
+            body['next'] = _page_cursor(following) if following else None
+        return _streamed(stream, body, 'cards', _card_payloads(cards, owner_email, email, names, fields))
+
+    if _wants_attribution(fields):
+        payload, multi_author = _attribute(cards, _collection_owner(link, email), email)
+        if contributors is not None:
+            # Whether a deck has several authors is a question about all of it.
+            multi_author = len(contributors) > 1
+        body = {'cards': payload, 'multi_author': multi_author}
+    else:
+        body = {'cards': [_card_payload(term, _normalise_card(value)) for term, value in cards.items()]}
+    if fields is not None:
+        body['cards'] = [{field: value for field, value in card.items() if field in fields}
+                         for card in body['cards']]
+    if limit is not None:
+        body['next'] = _page_cursor(following) if following else None
+    return _json_response(body)
+
+
+@app.route('/api/cards/changes', methods=['GET'])
+@cross_origin(headers=["Content-Type", "Authorization"])
+def get_card_changes():
+    """The cards of a collection written and deleted since `since`, a cursor
+    an earlier call returned. Without one, or with one that no longer applies,
+    every card, marked `reset`."""
+    if flashcards_collection is None:
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
-    cards, link = _resolve_collection(user_doc, collection_name)
+    email = _account_email(request.args.get('email'))
+    if not email:
+        return _json_response({"status": 400, "error": "email query parameter is required"}), 400
+
+    collection_name = request.args.get('collection', 'Default')
+    sync_id, since = _parse_cursor(request.args.get('since'))
+    # Taken before anything is read: a write landing after this is sent next time.
+    issued_at = _now_ms()
+
+    user_doc = _load_user_deck(email, collection_name)
+    owner_doc, deck_name, link, deck_id = None, collection_name, None, ''
+    if user_doc and collection_name in migrate_user_to_collections(user_doc):
+        owner_doc = user_doc
+        deck_id = _collection_meta(owner_doc).get(collection_name, {}).get('sync_id', '')
+    elif user_doc:
+        link = _linked_collections(user_doc).get(collection_name)
+        share = _find_share(link.get('share_id')) if link else None
+        if share:
+            deck_name = share['collection_name']
+            owner_doc = _load_user_deck(share['owner_email'], deck_name)
+        if owner_doc and deck_name in migrate_user_to_collections(owner_doc):
+            # Replacing the owner's deck, or following it afresh, starts over.
+            owner_sync_id = _collection_meta(owner_doc).get(deck_name, {}).get('sync_id', '')
+            deck_id = hashlib.sha1(f"{share['share_id']}:{owner_sync_id}:{link.get('followed_at')}"
+                                   .encode()).hexdigest()[:12]
+        else:
+            owner_doc = None
+
+    reset = (owner_doc is None or since is None or sync_id != deck_id
+             or since < issued_at - SYNC_TOMBSTONE_TTL * 1000)
+    deleted = []
+    if owner_doc is None:
+        cards = {}
+    elif reset:
+        cards = _owned_deck(owner_doc, deck_name) or {}
+    else:
+        after = since - SYNC_OVERLAP_MS
+        tombstones = _collection_meta(owner_doc).get(deck_name, {}).get('deleted') or {}
+        deleted = [term for term, at in tombstones.items() if at > after]
+        progress = (link or {}).get('progress') or {}
+        progressed = [term for term, mine in progress.items() if (mine.get('changed') or 0) > after]
+        # Tombstoned terms are asked for too: one written again since is not deleted.
+        cards = _changed_cards(owner_doc, deck_name, after, deleted + progressed)
+        deleted = [term for term in deleted if term not in cards]
+    if link is not None:
+        cards = _with_progress(cards, link)
 
     payload, multi_author = _attribute(cards, _collection_owner(link, email), email)
-    return Response(json.dumps({'cards': payload, 'multi_author': multi_author}),
-                    mimetype='application/json')
+    body = {'cursor': f'{deck_id}:{issued_at}', 'reset': reset, 'cards': payload, 'deleted': deleted}
+    if reset:
+        # Only the whole deck says who has written to it.
+        body['multi_author'] = multi_author
+    return _json_response(body)
 
 
 @app.route('/api/review', methods=['POST'])
@@ -963,35 +3236,34 @@ def get_cards():
 def record_review():
     """Record the outcome of studying one card."""
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"})
+        return _json_response({"status": 500, "error": "Database not connected"})
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data or 'word' not in data or 'outcome' not in data:
-        return jsonify({"status": 400, "error": "Missing required fields"})
+        return _json_response({"status": 400, "error": "Missing required fields"})
 
     outcome = data['outcome']
     if outcome not in ('correct', 'incorrect'):
-        return jsonify({"status": 400, "error": "outcome must be 'correct' or 'incorrect'"})
+        return _json_response({"status": 400, "error": "outcome must be 'correct' or 'incorrect'"})
 
-    token = data['token']
+    token = _account_email(data['token'])
     word = data['word']
     collection_name = data.get('collection', 'Default')
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user_deck(token, collection_name)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"})
+        return _json_response({"status": 404, "error": "User not found"})
 
     collections = migrate_user_to_collections(user_doc)
-    cards = collections.get(collection_name)
 
     # A followed deck's cards belong to someone else; only the progress is
     # this account's, so a review updates that and leaves the deck alone.
-    if cards is None:
+    if collection_name not in collections:
         resolved, link = _resolve_collection(user_doc, collection_name)
         if link is None:
-            return jsonify({"status": 404, "error": "Collection not found"})
+            return _json_response({"status": 404, "error": "Collection not found"})
         if word not in resolved:
-            return jsonify({"status": 404, "error": "Word not found"})
+            return _json_response({"status": 404, "error": "Word not found"})
 
         card = _normalise_card(resolved[word])
         card['seen'] += 1
@@ -1003,24 +3275,24 @@ def record_review():
             card['incorrect'] += 1
             card['needs_review'] = True
 
-        flashcards_collection.update_one(
-            {'user_email': token},
+        _update_user(
+            token,
             {'$set': {
-                f'linked_collections.{collection_name}.progress.{word}': {
+                f'{_link_field_path(collection_name)}.progress.{_escape_key(word)}': {
                     'seen': card['seen'], 'correct': card['correct'],
                     'incorrect': card['incorrect'], 'needs_review': card['needs_review'],
-                    'last_reviewed': card['last_reviewed'],
+                    'last_reviewed': card['last_reviewed'], 'changed': _now_ms(),
                 },
                 'updated_at': datetime.utcnow(),
             }},
         )
-        return Response(json.dumps({'status': 200, 'card': _card_payload(word, card)}),
-                        mimetype='application/json')
+        return _json_response({'status': 200, 'card': _card_payload(word, card)})
 
-    if word not in cards:
-        return jsonify({"status": 404, "error": "Word not found"})
+    stored = _owned_card(user_doc, collection_name, word)
+    if stored is None:
+        return _json_response({"status": 404, "error": "Word not found"})
 
-    card = _normalise_card(cards[word])
+    card = _normalise_card(stored)
     card['seen'] += 1
     card['last_reviewed'] = datetime.utcnow().isoformat()
     if outcome == 'correct':
@@ -1030,62 +3302,52 @@ def record_review():
         card['incorrect'] += 1
         card['needs_review'] = True
 
-    cards[word] = card
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}}
-    )
+    _write_review(user_doc, collection_name, word, card, outcome, stored)
 
-    return Response(
-        json.dumps({'status': 200, 'card': _card_payload(word, card)}),
-        mimetype='application/json',
-    )
+    return _json_response({'status': 200, 'card': _card_payload(word, card)})
 
 
 @app.route('/api/progress', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
+@_conditional(_deck_tag)
 def get_progress():
     """Real study statistics, derived from recorded review outcomes."""
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
-    email = request.args.get('email')
+    email = _account_email(request.args.get('email'))
     if not email:
-        return jsonify({"status": 400, "error": "email query parameter is required"}), 400
+        return _json_response({"status": 400, "error": "email query parameter is required"}), 400
 
     collection_name = request.args.get('collection', 'Default')
 
     empty = {'total': 0, 'studied': 0, 'unseen': 0, 'needs_review': 0,
              'known': 0, 'attempts': 0, 'accuracy': 0, 'last_reviewed': None}
 
-    user_doc = flashcards_collection.find_one({'user_email': email})
+    user_doc = _load_user_deck(email, collection_name)
     if not user_doc:
-        return Response(json.dumps(empty), mimetype='application/json')
+        return _json_response(empty)
 
-    resolved, _ = _resolve_collection(user_doc, collection_name)
-    cards = list(resolved.values())
-    if not cards:
-        return Response(json.dumps(empty), mimetype='application/json')
-
-    studied = sum(1 for c in cards if c['seen'] > 0)
-    needs_review = sum(1 for c in cards if c['needs_review'])
-    # "Known" means answered at least once and not currently flagged. A card you
-    # have never opened is neither known nor unknown.
-    known = sum(1 for c in cards if c['seen'] > 0 and not c['needs_review'])
-    correct = sum(c['correct'] for c in cards)
-    attempts = correct + sum(c['incorrect'] for c in cards)
-    timestamps = [c['last_reviewed'] for c in cards if c['last_reviewed']]
-
-    return Response(json.dumps({
-        'total': len(cards),
-        'studied': studied,
-        'unseen': len(cards) - studied,
-        'needs_review': needs_review,
-        'known': known,
+    if collection_name in migrate_user_to_collections(user_doc):
+        summary = _deck_summary(user_doc, collection_name)
+    else:
+        resolved, _ = _resolve_collection(user_doc, collection_name)
+        summary = _summary_of(resolved)
+    if not summary['total']:
+        return _json_response(empty)
+
+    attempts = summary['correct'] + summary['incorrect']
+
+    return _json_response({
+        'total': summary['total'],
+        'studied': summary['studied'],
+        'unseen': summary['total'] - summary['studied'],
+        'needs_review': summary['needs_review'],
+        'known': summary['known'],
         'attempts': attempts,
-        'accuracy': round(correct / attempts * 100) if attempts else 0,
-        'last_reviewed': max(timestamps) if timestamps else None,
-    }), mimetype='application/json')
+        'accuracy': round(summary['correct'] / attempts * 100) if attempts else 0,
+        'last_reviewed': summary.get('last_reviewed'),
+    })
 
 
 # Card images
@@ -1144,7 +3406,7 @@ def _card_image_ids(cards):
 
 @app.errorhandler(413)
 def handle_too_large(error):
-    return jsonify({
+    return _json_response({
         "status": 413,
         "error": f"Image is too large. The limit is {MAX_IMAGE_BYTES // (1024 * 1024)}MB.",
     }), 413
@@ -1155,25 +3417,25 @@ def handle_too_large(error):
 def upload_image():
     """Store a picture and return the id a card refers to it by."""
     if images is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     upload = request.files.get('file')
-    token = request.form.get('token')
+    token = _account_email(request.form.get('token'))
     if not upload or not token:
-        return jsonify({"status": 400, "error": "A file and a token are required"}), 400
+        return _json_response({"status": 400, "error": "A file and a token are required"}), 400
 
     content_type = (upload.mimetype or "").lower()
     if content_type not in ALLOWED_IMAGE_TYPES:
-        return jsonify({
+        return _json_response({
             "status": 400,
             "error": "Unsupported image type. Use JPEG, PNG, GIF, WEBP or HEIC.",
         }), 400
 
     data = upload.read()
     if not data:
-        return jsonify({"status": 400, "error": "The file is empty"}), 400
+        return _json_response({"status": 400, "error": "The file is empty"}), 400
     if len(data) > MAX_IMAGE_BYTES:
-        return jsonify({
+        return _json_response({
             "status": 413,
             "error": f"Image is too large. The limit is {MAX_IMAGE_BYTES // (1024 * 1024)}MB.",
         }), 413
@@ -1184,8 +3446,7 @@ def upload_image():
         filename=upload.filename or "card-image",
         metadata={"user_email": token, "uploaded_at": datetime.utcnow().isoformat()},
     )
-    return Response(json.dumps({"status": 200, "image_id": str(image_id)}),
-                    mimetype='application/json')
+    return _json_response({"status": 200, "image_id": str(image_id)})
 
 
 def _follower_may_read_image(email, image_id, owner):
@@ -1203,9 +3464,9 @@ def _follower_may_read_image(email, image_id, owner):
     if flashcards_collection is None or shares_collection is None:
         return False
 
-    user_doc = flashcards_collection.find_one({'user_email': email})
+    user_doc = _load_user(email)
     for link in _linked_collections(user_doc).values():
-        share = shares_collection.find_one({'share_id': link.get('share_id')})
+        share = _find_share(link.get('share_id'))
         if not share or share.get('owner_email') != owner:
             continue
         _, source = _shared_source(share)
@@ -1225,29 +3486,28 @@ def get_image(image_id):
     address as the key to an account's data.
     """
     if images is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
-    email = request.args.get('email')
+    email = _account_email(request.args.get('email'))
     share_id = request.args.get('share')
     if not email and not share_id:
-        return jsonify({"status": 400, "error": "email or share query parameter is required"}), 400
+        return _json_response({"status": 400, "error": "email or share query parameter is required"}), 400
 
     try:
         stored = images.get(ObjectId(image_id))
     except (InvalidId, TypeError, gridfs.errors.NoFile):
-        return jsonify({"status": 404, "error": "Image not found"}), 404
+        return _json_response({"status": 404, "error": "Image not found"}), 404
 
     owner = (stored.metadata or {}).get("user_email")
 
     # Someone previewing a share is not the owner, so authorise them through
     # the link instead: the picture must belong to whoever shared it.
     if share_id:
-        share = (shares_collection.find_one({'share_id': share_id})
-                 if shares_collection is not None else None)
+        share = _find_share(share_id)
         if not share or (owner and owner != share['owner_email']):
-            return jsonify({"status": 404, "error": "Image not found"}), 404
+            return _json_response({"status": 404, "error": "Image not found"}), 404
     elif owner and owner != email and not _follower_may_read_image(email, image_id, owner):
-        return jsonify({"status": 404, "error": "Image not found"}), 404
+        return _json_response({"status": 404, "error": "Image not found"}), 404
 
     response = Response(stored.read(), mimetype=stored.content_type or "application/octet-stream")
     # The bytes behind an id never change, so this can be cached hard.
@@ -1360,52 +3620,44 @@ def parse_deck_json(payload):
 def import_deck_json():
     """Create a deck from a JSON document."""
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    token = data['token']
+    token = _account_email(data['token'])
     payload = data.get('deck')
     if payload is None:
-        return jsonify({"status": 400, "error": "Missing deck in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing deck in request body"}), 400
 
     try:
         parsed_name, cards, warnings = parse_deck_json(payload)
     except ValueError as error:
-        return jsonify({"status": 400, "error": str(error)}), 400
+        return _json_response({"status": 400, "error": str(error)}), 400
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     collections = migrate_user_to_collections(user_doc) if user_doc else {}
 
     requested = (data.get('name') or parsed_name or "Imported").strip()
     name = _unique_collection_name(collections, requested)
 
-    collections[name] = {
+    deck = {
         term: _stamp_created(_default_card(definition), token)
         for term, definition in cards.items()
     }
 
     if user_doc:
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}},
-        )
-    else:
-        flashcards_collection.insert_one({
-            'user_email': token,
-            'collections': collections,
-            'default_collection': name,
-            'created_at': datetime.utcnow(),
-        })
+        _write_collection(user_doc, name, deck)
+    elif not _insert_user(token, name, {name: deck}):
+        return import_deck_json()
 
-    return Response(json.dumps({
+    return _json_response({
         'status': 200,
         'collection': name,
         'imported': len(cards),
         'warnings': warnings,
-    }), mimetype='application/json')
+    })
 
 
 @app.route('/api/profile', methods=['POST'])
@@ -1423,13 +3675,13 @@ def save_profile():
     this simply has no name attached.
     """
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    token = data['token']
+    token = _account_email(data['token'])
     name = (data.get('name') or '').strip()[:60]
 
     update = {'updated_at': datetime.utcnow()}
@@ -1437,12 +3689,13 @@ def save_profile():
         update['display_name'] = name
 
     # Upsert: someone can sign in before they own any cards.
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': update, '$setOnInsert': {'collections': {}, 'created_at': datetime.utcnow()}},
+    _update_user(
+        token,
+        {'$set': update, '$setOnInsert': {'collections': {}, **_new_user_fields()}},
         upsert=True,
     )
-    return jsonify({"status": 200, "display_name": name or None})
+    _forget_display_name(token)
+    return _json_response({"status": 200, "display_name": name or None})
 
 
 @app.route('/api/collections/<collection_name>/cover', methods=['POST'])
@@ -1454,40 +3707,34 @@ def set_collection_cover(collection_name):
     way they do for cards.
     """
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    token = data['token']
+    token = _account_email(data['token'])
     image_id = data.get('image') or None
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"}), 404
+        return _json_response({"status": 404, "error": "User not found"}), 404
 
     collections = migrate_user_to_collections(user_doc)
     if collection_name not in collections:
-        return jsonify({"status": 404, "error": "Collection not found"}), 404
+        return _json_response({"status": 404, "error": "Collection not found"}), 404
 
-    meta = dict(_collection_meta(user_doc))
-    previous = meta.get(collection_name, {}).get('cover_image')
+    previous = _cover_of(user_doc, collection_name)
     if previous and previous != image_id:
         _delete_image(previous)
 
-    entry = dict(meta.get(collection_name, {}))
+    path = f'{_meta_field_path(collection_name)}.cover_image'
     if image_id:
-        entry['cover_image'] = image_id
+        update = {'$set': {path: image_id, 'updated_at': datetime.utcnow()}}
     else:
-        entry.pop('cover_image', None)
-    meta[collection_name] = entry
-
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'collection_meta': meta, 'updated_at': datetime.utcnow()}},
-    )
-    return jsonify({"status": 200, "cover": image_id})
+        update = {'$unset': {path: ""}, '$set': {'updated_at': datetime.utcnow()}}
+    _update_user(token, update)
+    return _json_response({"status": 200, "cover": image_id})
 
 
 # Followed decks
@@ -1512,10 +3759,10 @@ def _shared_source(share):
     """The cards behind a share, or None if it no longer resolves."""
     if flashcards_collection is None or not share:
         return None, None
-    owner_doc = flashcards_collection.find_one({'user_email': share['owner_email']})
+    owner_doc = _load_user_deck(share['owner_email'], share['collection_name'])
     if not owner_doc:
         return None, None
-    cards = migrate_user_to_collections(owner_doc).get(share['collection_name'])
+    cards = _owned_deck(owner_doc, share['collection_name'])
     if cards is None:
         return None, None
     return owner_doc, cards
@@ -1530,20 +3777,23 @@ def _resolve_collection(user_doc, collection_name):
     if user_doc is None:
         return {}, None
 
-    owned = migrate_user_to_collections(user_doc)
-    if collection_name in owned:
-        return owned[collection_name], None
+    owned = _owned_deck(user_doc, collection_name)
+    if owned is not None:
+        return owned, None
 
     link = _linked_collections(user_doc).get(collection_name)
     if not link or shares_collection is None:
         return {}, None
 
-    share = shares_collection.find_one({'share_id': link.get('share_id')})
+    share = _find_share(link.get('share_id'))
     _, source = _shared_source(share)
     if source is None:
         return {}, link
+    return _with_progress(source, link), link
 
-    # The follower's own history, laid over shared content.
+
+def _with_progress(source, link):
+    """The follower's own history, laid over shared content."""
     progress = link.get('progress') or {}
     merged = {}
     for term, value in source.items():
@@ -1555,14 +3805,64 @@ def _resolve_collection(user_doc, collection_name):
         card['needs_review'] = mine.get('needs_review', False)
         card['last_reviewed'] = mine.get('last_reviewed')
         merged[term] = card
-    return merged, link
+    return merged
+
+
+def _followed_decks(user_doc):
+    """Every deck the account follows, resolved at once.
+
+    Returns {name: (cards, share, owner_doc)}, with cards None for a link that
+    no longer resolves. The shares, their owners and -- for owners keeping them
+    there -- the cards collection are each queried once, however many decks
+    are followed; one at a time, a reader following thirty decks cost over a
+    hundred round trips.
+    """
+    links = _linked_collections(user_doc)
+    if not links or shares_collection is None:
+        return {name: (None, None, None) for name in links}
+
+    share_ids = [link.get('share_id') for link in links.values()]
+    shares = _find_shares(share_ids)
+
+    # Only the shared decks of each owner, and what is shown about them.
+    projection = {field: 1 for field in (*_DOCUMENT_STATE_FIELDS, 'display_name')}
+    for share in shares.values():
+        projection[_collection_field_path(share['collection_name'])] = 1
+    owner_emails = list({share['owner_email'] for share in shares.values()})
+    owners = {}
+    for owner_doc in flashcards_collection.find({'user_email': {'$in': owner_emails}}, projection):
+        owners[owner_doc['user_email']] = _decoded_partial_user(owner_doc)
+
+    wanted = [{'user_email': share['owner_email'], 'collection': share['collection_name']}
+              for share in shares.values()
+              if _cards_in_collection(owners.get(share['owner_email']))]
+    card_documents = {}
+    if wanted:
+        for doc in cards_collection.find({'$or': wanted}, {'_id': 0}).sort('_id', 1):
+            deck = card_documents.setdefault((doc.pop('user_email'), doc.pop('collection')), {})
+            deck[doc.pop('term')] = doc
+
+    resolved = {}
+    for name, link in links.items():
+        share = shares.get(link.get('share_id'))
+        owner_doc = owners.get(share['owner_email']) if share else None
+        source = None
+        if owner_doc is not None:
+            shared_name = share['collection_name']
+            if not _cards_in_collection(owner_doc):
+                source = _current_deck(owner_doc, shared_name)
+            elif shared_name in migrate_user_to_collections(owner_doc):
+                source = card_documents.get((share['owner_email'], shared_name), {})
+        cards = _with_progress(source, link) if source is not None else None
+        resolved[name] = (cards, share, owner_doc)
+    return resolved
 
 
 def _collection_owner(link, viewer_email):
     """Whose deck this is: the follower's own, or the person they follow."""
     if link is None or shares_collection is None:
         return viewer_email
-    share = shares_collection.find_one({'share_id': link.get('share_id')})
+    share = _find_share(link.get('share_id'))
     return (share or {}).get('owner_email') or viewer_email
 
 
@@ -1583,13 +3883,13 @@ def _followed_write_target(user_doc, token, collection_name):
     if not link:
         return None, None
     if shares_collection is None:
-        return None, (jsonify({"status": 500, "error": "Database not connected"}), 500)
+        return None, (_json_response({"status": 500, "error": "Database not connected"}), 500)
 
-    share = shares_collection.find_one({'share_id': link.get('share_id')})
+    share = _find_share(link.get('share_id'))
     if not share:
-        return None, (jsonify({"status": 404, "error": "That shared deck is no longer available"}), 404)
+        return None, (_json_response({"status": 404, "error": "That shared deck is no longer available"}), 404)
     if not share.get('allow_edit'):
-        return None, (jsonify({
+        return None, (_json_response({
             "status": 403,
             "error": "This deck is shared read-only. Ask the owner to allow editing.",
         }), 403)
@@ -1601,27 +3901,27 @@ def _followed_write_target(user_doc, token, collection_name):
 def follow_share(share_id):
     """Add a shared deck to an account without copying it."""
     if flashcards_collection is None or shares_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True) or {}
-    token = data.get('token')
+    token = _account_email(data.get('token'))
     if not token:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    share = shares_collection.find_one({'share_id': share_id})
+    share = _find_share(share_id)
     if not share:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
     if share['owner_email'] == token:
-        return jsonify({
+        return _json_response({
             "status": 400,
             "error": "This is your own deck. It is already in your collections.",
         }), 400
 
     _, source = _shared_source(share)
     if source is None:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     owned = migrate_user_to_collections(user_doc) if user_doc else {}
     links = dict(_linked_collections(user_doc))
 
@@ -1629,26 +3929,20 @@ def follow_share(share_id):
     # second entry pointing at the same deck.
     for name, link in links.items():
         if link.get('share_id') == share_id:
-            return jsonify({"status": 200, "collection": name, "already": True})
+            return _json_response({"status": 200, "collection": name, "already": True})
 
     name = _unique_collection_name({**owned, **links}, share['collection_name'])
-    links[name] = {'share_id': share_id, 'progress': {}, 'followed_at': datetime.utcnow().isoformat()}
+    link = {'share_id': share_id, 'progress': {}, 'followed_at': datetime.utcnow().isoformat()}
 
     if user_doc:
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'linked_collections': links, 'updated_at': datetime.utcnow()}},
+        _update_user(
+            token,
+            {'$set': {_link_field_path(name): link, 'updated_at': datetime.utcnow()}},
         )
-    else:
-        flashcards_collection.insert_one({
-            'user_email': token,
-            'collections': {},
-            'linked_collections': links,
-            'default_collection': name,
-            'created_at': datetime.utcnow(),
-        })
+    elif not _insert_user(token, name, linked_collections={name: link}):
+        return follow_share(share_id)
 
-    return jsonify({"status": 200, "collection": name, "cards": len(source)})
+    return _json_response({"status": 200, "collection": name, "cards": len(source)})
 
 
 @app.route('/api/collections/<collection_name>/unfollow', methods=['POST'])
@@ -1656,24 +3950,23 @@ def follow_share(share_id):
 def unfollow_collection(collection_name):
     """Stop following a shared deck. The owner's deck is untouched."""
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True) or {}
-    token = data.get('token')
+    token = _account_email(data.get('token'))
     if not token:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
-    links = dict(_linked_collections(user_doc))
-    if collection_name not in links:
-        return jsonify({"status": 404, "error": "You are not following that deck"}), 404
+    user_doc = _load_user(token)
+    if collection_name not in _linked_collections(user_doc):
+        return _json_response({"status": 404, "error": "You are not following that deck"}), 404
 
-    del links[collection_name]
-    flashcards_collection.update_one(
-        {'user_email': token},
-        {'$set': {'linked_collections': links, 'updated_at': datetime.utcnow()}},
+    _update_user(
+        token,
+        {'$unset': {_link_field_path(collection_name): ""},
+         '$set': {'updated_at': datetime.utcnow()}},
     )
-    return jsonify({"status": 200})
+    return _json_response({"status": 200})
 
 
 # Sharing collections
@@ -1690,6 +3983,219 @@ def unfollow_collection(collection_name):
 # their account.
 
 
+# A link is resolved several times a request, and by every request for a
+# followed deck, while shares themselves change only when an owner shares,
+# unshares, renames or deletes a deck. So the ones in use are kept in memory.
+# Those four drop what they change here at once; another worker's copy lasts
+# at most SHARE_CACHE_TTL seconds more, which bounds how long a revoked link
+# can keep working.
+
+SHARE_CACHE_SIZE = int(os.environ.get('SHARE_CACHE_SIZE', 10000))
+SHARE_CACHE_TTL = int(os.environ.get('SHARE_CACHE_TTL', 60))
+_share_cache = _LRUCache(SHARE_CACHE_SIZE, name='shares')
+# Moved on by every change to a share, so that a lookup which read a share
+# from before the change does not keep it.
+_share_epoch = 0
+
+
+def _find_shares(share_ids):
+    """The shares behind `share_ids`, keyed by id; ids with none are left
+    out. Read from memory, then the shared cache, then MongoDB."""
+    wanted = [share_id for share_id in dict.fromkeys(share_ids) if share_id]
+    if not wanted or shares_collection is None:
+        return {}
+    epoch = _share_epoch
+    found = {}
+    for share_id in wanted:
+        share = _mapped(('share', share_id))
+        if share is None:
+            share = _share_cache.get(share_id)
+            share = dict(share) if share is not None else None
+            _map(('share', share_id), share)
+        if share is not None:
+            found[share_id] = share
+    missing = [share_id for share_id in wanted if share_id not in found]
+    if not missing:
+        return found
+
+    loaded = {}
+    if _shared_cache is not None:
+        held = _shared_cache.get_many([f'share:{share_id}' for share_id in missing])
+        loaded = {share_id: share for share_id, share in zip(missing, held) if share is not None}
+    unshared = [share_id for share_id in missing if share_id not in loaded
+                and _dead_shares.get(share_id) is None and _share_may_exist(share_id)]
+    if unshared:
+        stored = {share['share_id']: share
+                  for share in shares_collection.find({'share_id': {'$in': unshared}})}
+        if _shared_cache is not None:
+            _shared_cache.set_many({f'share:{share_id}': share for share_id, share in stored.items()})
+        expires_at = time.time() + NEGATIVE_CACHE_TTL
+        for share_id in unshared:
+            if share_id not in stored:
+                _dead_shares.set(share_id, True, expires_at=expires_at)
+        loaded.update(stored)
+
+    if epoch == _share_epoch:
+        expires_at = time.time() + SHARE_CACHE_TTL
+        for share_id, share in loaded.items():
+            _share_cache.set(share_id, dict(share), expires_at=expires_at)
+    for share_id, share in loaded.items():
+        _map(('share', share_id), share)
+    found.update(loaded)
+    return found
+
+
+def _find_share(share_id):
+    return _find_shares([share_id]).get(share_id)
+
+
+# Dead links
+#
+# Crawlers and stale clients ask for links that do not exist, and each of those
+# used to cost a query to find nothing. A link found dead is remembered for
+# NEGATIVE_CACHE_TTL seconds. Beyond that, every worker keeps a Bloom filter
+# of the share_ids that do exist. A link the filter rules out is answered
+# without MongoDB; one it lets through -- every live link, and about one dead
+# one in a hundred -- is looked up as before.
+#
+# The filter is rebuilt from scratch in the background every
+# SHARE_FILTER_REBUILD seconds, which is what drops revoked links from it.
+# Links made in this process are added as they are made. Before ruling a link
+# out, a worker adds those made elsewhere since it last looked: with a shared
+# cache, whenever a share has been made since (every new share deletes a
+# token there); without one, at most once every SHARE_FILTER_SYNC seconds. A
+# link made elsewhere in between would be ruled out, so without a shared cache
+# a link the filter rules out is still looked up, once, unless the filter was
+# synced after it was asked for; finding nothing is remembered as above.
+
+SHARE_FILTER_REBUILD = int(os.environ.get('SHARE_FILTER_REBUILD', 600))
+SHARE_FILTER_SYNC = 1
+SHARE_FILTER_ERROR_RATE = 0.01
+# Shares are stamped by the clock of whichever worker made them; looking back
+# a little further than the last look covers clocks that disagree.
+SHARE_FILTER_OVERLAP = timedelta(seconds=30)
+_dead_shares = _LRUCache(SHARE_CACHE_SIZE, name='dead_shares')
+_share_filter = {'bloom': None, 'built_at': 0, 'synced_at': 0, 'since': None, 'token': None,
+                 'building': False}
+_share_filter_lock = threading.Lock()
+
+
+class _BloomFilter:
+    """A set that can only say "certainly not in it" or "probably in it", in
+    about ten bits a member at the default error rate."""
+
+    def __init__(self, capacity, error_rate=SHARE_FILTER_ERROR_RATE):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+def _shares_made_token():
+    if _shared_cache is None:
+        return None
+    return _shared_cache.token('shares-made', create=True)
+
+
+def _rebuild_share_filter():
+    try:
+        since = datetime.utcnow() - SHARE_FILTER_OVERLAP
+        share_ids = [share['share_id'] for share in shares_collection.find({}, {'share_id': 1})]
+        # Room to grow until the next rebuild without the error rate climbing.
+        bloom = _BloomFilter(max(2 * len(share_ids), 1024))
+        for share_id in share_ids:
+            bloom.add(share_id)
+        with _share_filter_lock:
+            _share_filter.update(bloom=bloom, since=since)
+        # Whatever was made while the ids were being read.
+        _sync_share_filter()
+    except Exception as error:
+        app.logger.error(f"Share filter rebuild failed: {error}", exc_info=True)
+    finally:
+        with _share_filter_lock:
+            _share_filter['building'] = False
+
+
+def _sync_share_filter():
+    """Add the shares made since the filter last looked."""
+    token = _shares_made_token()
+    now = datetime.utcnow()
+    with _share_filter_lock:
+        bloom, since = _share_filter['bloom'], _share_filter['since']
+    for share in shares_collection.find({'created_at': {'$gte': since}}, {'share_id': 1}):
+        bloom.add(share['share_id'])
+    with _share_filter_lock:
+        _share_filter.update(since=now - SHARE_FILTER_OVERLAP, synced_at=time.time(), token=token)
+
+
+def _share_filter_stale():
+    token = _shares_made_token()
+    if token is not None:
+        return token != _share_filter['token']
+    return time.time() - _share_filter['synced_at'] > SHARE_FILTER_SYNC
+
+
+def _share_may_exist(share_id):
+    """False only if there is certainly no share with this id."""
+    asked_at = time.time()
+    with _share_filter_lock:
+        rebuild = (not _share_filter['building']
+                   and time.time() - _share_filter['built_at'] > SHARE_FILTER_REBUILD)
+        if rebuild:
+            # Counted from the attempt, so a failing rebuild is retried on the
+            # same schedule rather than by every request.
+            _share_filter.update(building=True, built_at=time.time())
+        bloom = _share_filter['bloom']
+    if rebuild:
+        threading.Thread(target=_rebuild_share_filter, name='share-filter', daemon=True).start()
+    if bloom is None or share_id in bloom:
+        return True
+    if _share_filter_stale():
+        _sync_share_filter()
+    if share_id in _share_filter['bloom']:
+        return True
+    return _shared_cache is None and _share_filter['synced_at'] < asked_at
+
+
+def _share_made(share_id):
+    """Let every worker's filter know a share now exists."""
+    with _share_filter_lock:
+        bloom = _share_filter['bloom']
+    if bloom is not None:
+        bloom.add(share_id)
+    if _shared_cache is not None:
+        _shared_cache.delete('shares-made')
+
+
+def _share_ids_for(owner_email, collection_name):
+    return [share['share_id'] for share in shares_collection.find(
+        {'owner_email': owner_email, 'collection_name': collection_name}, {'share_id': 1})]
+
+
+def _forget_shares(share_ids):
+    """Drop cached copies of shares that have just changed or gone."""
+    global _share_epoch
+    _share_epoch += 1
+    for share_id in share_ids:
+        _share_cache.pop(share_id)
+        _unmap(lambda key: key == ('share', share_id))
+    if _shared_cache is not None:
+        _shared_cache.delete(*[f'share:{share_id}' for share_id in share_ids])
+
+
 def _share_url_path(share_id):
     return f"/import/{share_id}"
 
@@ -1708,24 +4214,24 @@ def _share_payload(share):
 def share_collection(collection_name):
     """Create a share link for a collection, or return the one it already has."""
     if flashcards_collection is None or shares_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    token = data['token']
+    token = _account_email(data['token'])
     # Accepted for clients that send it inline, but the account's own name wins:
     # see /api/profile.
     display_name = (data.get('display_name') or '').strip()[:60] or None
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"}), 404
+        return _json_response({"status": 404, "error": "User not found"}), 404
 
     collections = migrate_user_to_collections(user_doc)
     if collection_name not in collections:
-        return jsonify({"status": 404, "error": "Collection not found"}), 404
+        return _json_response({"status": 404, "error": "Collection not found"}), 404
 
     # Idempotent: sharing twice hands back the same link rather than making a
     # second one that also works forever.
@@ -1742,9 +4248,9 @@ def share_collection(collection_name):
             changes['allow_edit'] = bool(data['allow_edit'])
         if changes:
             shares_collection.update_one({'_id': existing['_id']}, {'$set': changes})
+            _forget_shares([existing['share_id']])
             existing.update(changes)
-        return Response(json.dumps({"status": 200, **_share_payload(existing)}),
-                        mimetype='application/json')
+        return _json_response({"status": 200, **_share_payload(existing)})
 
     share = {
         'share_id': secrets.token_urlsafe(9),
@@ -1758,8 +4264,8 @@ def share_collection(collection_name):
         'created_at': datetime.utcnow(),
     }
     shares_collection.insert_one(share)
-    return Response(json.dumps({"status": 200, **_share_payload(share)}),
-                    mimetype='application/json')
+    _share_made(share['share_id'])
+    return _json_response({"status": 200, **_share_payload(share)})
 
 
 @app.route('/api/collections/<collection_name>/share', methods=['DELETE'])
@@ -1767,57 +4273,65 @@ def share_collection(collection_name):
 def unshare_collection(collection_name):
     """Revoke a share link. Copies already taken are unaffected."""
     if shares_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    result = shares_collection.delete_one({
-        'owner_email': data['token'], 'collection_name': collection_name,
+    revoked = shares_collection.find_one_and_delete({
+        'owner_email': _account_email(data['token']), 'collection_name': collection_name,
     })
-    if result.deleted_count == 0:
-        return jsonify({"status": 404, "error": "That collection is not shared"}), 404
-    return jsonify({"status": 200})
+    if revoked is None:
+        return _json_response({"status": 404, "error": "That collection is not shared"}), 404
+    _forget_shares([revoked['share_id']])
+    return _json_response({"status": 200})
+
+
+# What a share link shows of each card.
+SHARED_CARD_FIELDS = {'term', 'definition', 'image'}
 
 
 @app.route('/api/shares/<share_id>', methods=['GET'])
 @cross_origin(headers=["Content-Type", "Authorization"])
+@_conditional(_share_tag)
 def get_share(share_id):
     """What is behind a share link. Deliberately open: holding the link is the
     permission, and a recipient has to see what they are importing first."""
     if flashcards_collection is None or shares_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
-    share = shares_collection.find_one({'share_id': share_id})
+    share = _find_share(share_id)
     if not share:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
 
-    owner_doc = flashcards_collection.find_one({'user_email': share['owner_email']})
+    owner_doc = _load_user(share['owner_email'])
     if not owner_doc:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
 
-    collections = migrate_user_to_collections(owner_doc)
-    cards = collections.get(share['collection_name'])
+    stream = _stream_format()
+    collection_name = share['collection_name']
+    if stream and _cards_in_collection(owner_doc):
+        cards = None
+        if collection_name in migrate_user_to_collections(owner_doc):
+            card_count = cards_collection.count_documents({'user_email': owner_doc['user_email'],
+                                                           'collection': collection_name})
+            cards = _iter_owned_deck(owner_doc, collection_name, fields=SHARED_CARD_FIELDS)
+    else:
+        cards = _owned_deck(owner_doc, collection_name)
+        card_count = len(cards or {})
     if cards is None:
         # The owner renamed or deleted it after sharing.
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
 
     # Review history is the owner's, not part of what is being shared.
-    payload = []
-    for term, value in cards.items():
-        card = _normalise_card(value)
-        payload.append({
-            'term': term,
-            'definition': card['definition'],
-            'image': card['image'],
-        })
+    payload = _card_payloads(cards, None, None, None, SHARED_CARD_FIELDS)
 
     # A viewer that says who it is gets told whether the deck is already theirs,
     # so the page can offer something other than a button that cannot work.
     viewer = request.args.get('email')
 
-    return Response(json.dumps({
+    body = {
         'status': 200,
         'share_id': share_id,
         'collection': share['collection_name'],
@@ -1828,9 +4342,13 @@ def get_share(share_id):
         # made before profiles were recorded.
         'owner_name': _display_name_of(owner_doc) or share.get('owner_name'),
         'cover': _cover_of(owner_doc, share['collection_name']),
-        'card_count': len(payload),
+        'card_count': card_count,
         'cards': payload,
-    }), mimetype='application/json')
+    }
+    if stream:
+        return _streamed(stream, body, 'cards', payload)
+    body['cards'] = list(payload)
+    return _json_response(body)
 
 
 MAX_SHARED_DECK_CARDS = 1000
@@ -1839,52 +4357,38 @@ MAX_SHARED_DECK_CARDS = 1000
 def _open_shared_deck(share_id, token):
     """Resolve a share that grants editing, for a caller who supplies a token.
 
-    Returns (owner_doc, collections, cards, error_response). Only one of the
-    first three and the last is meaningful.
+    Returns (share, owner_doc, cards, error_response). Only one of the first
+    three and the last is meaningful.
     """
     if flashcards_collection is None or shares_collection is None:
-        return None, None, None, (jsonify({"status": 500, "error": "Database not connected"}), 500)
+        return None, None, None, (_json_response({"status": 500, "error": "Database not connected"}), 500)
     if not token:
-        return None, None, None, (jsonify({"status": 400, "error": "Missing token in request body"}), 400)
+        return None, None, None, (_json_response({"status": 400, "error": "Missing token in request body"}), 400)
 
-    share = shares_collection.find_one({'share_id': share_id})
+    share = _find_share(share_id)
     if not share:
-        return None, None, None, (jsonify({"status": 404, "error": "This link is no longer available"}), 404)
+        return None, None, None, (_json_response({"status": 404, "error": "This link is no longer available"}), 404)
 
     # Editing through a link is off unless the owner turned it on. The owner
     # themselves always reaches their own deck through the normal endpoints.
     if not share.get('allow_edit') and share['owner_email'] != token:
-        return None, None, None, (jsonify({
+        return None, None, None, (_json_response({
             "status": 403,
             "error": "This deck is shared read-only. Ask the owner to allow editing.",
         }), 403)
 
-    owner_doc = flashcards_collection.find_one({'user_email': share['owner_email']})
+    owner_doc = _load_user(share['owner_email'])
     if not owner_doc:
-        return None, None, None, (jsonify({"status": 404, "error": "This link is no longer available"}), 404)
+        return None, None, None, (_json_response({"status": 404, "error": "This link is no longer available"}), 404)
 
-    collections = migrate_user_to_collections(owner_doc)
-    cards = collections.get(share['collection_name'])
+    cards = _owned_deck(owner_doc, share['collection_name'])
     if cards is None:
-        return None, None, None, (jsonify({"status": 404, "error": "This link is no longer available"}), 404)
-
-    return share, collections, cards, None
+        return None, None, None, (_json_response({"status": 404, "error": "This link is no longer available"}), 404)
 
+    return share, owner_doc, cards, None
 
-def _card_field_path(collection_name, term):
-    """Dotted path to a single card, or None if the names cannot express one.
-
-    MongoDB reads a dot in an update key as a path separator, so a collection
-    or term containing one -- or starting with $ -- cannot be addressed this
-    way and has to fall back to rewriting the map.
-    """
-    for name in (collection_name, term):
-        if '.' in name or name.startswith('$'):
-            return None
-    return f'collections.{collection_name}.{term}'
 
-
-def _write_shared_card(share, collections, term, card, replaced_term=None):
+def _write_shared_card(share, owner_doc, term, card, replaced_term=None, previous=None):
     """Persist one card of a shared deck, touching only that card when possible.
 
     A shared deck has several people writing to it. Rewriting the whole
@@ -1892,23 +4396,8 @@ def _write_shared_card(share, collections, term, card, replaced_term=None):
     produce a last-writer-wins result: one person's card silently disappears.
     Addressing the single field lets the database merge both.
     """
-    collection_name = share['collection_name']
-    path = _card_field_path(collection_name, term)
-    old_path = (_card_field_path(collection_name, replaced_term)
-                if replaced_term and replaced_term != term else None)
-
-    if path is None or (replaced_term and replaced_term != term and old_path is None):
-        # Unaddressable name: fall back to the whole-map write.
-        flashcards_collection.update_one(
-            {'user_email': share['owner_email']},
-            {'$set': {'collections': collections, 'updated_at': datetime.utcnow()}},
-        )
-        return
-
-    update = {'$set': {path: card, 'updated_at': datetime.utcnow()}}
-    if old_path:
-        update['$unset'] = {old_path: ""}
-    flashcards_collection.update_one({'user_email': share['owner_email']}, update)
+    _write_card(owner_doc, share['collection_name'], term, card,
+                replaced_term=replaced_term, previous=previous)
 
 
 @app.route('/api/shares/<share_id>/cards', methods=['POST'])
@@ -1923,7 +4412,8 @@ def add_card_to_shared_deck(share_id):
     the owner.
     """
     data = request.get_json(silent=True) or {}
-    share, collections, cards, error = _open_shared_deck(share_id, data.get('token'))
+    token = _account_email(data.get('token'))
+    share, owner_doc, cards, error = _open_shared_deck(share_id, token)
     if error:
         return error
 
@@ -1931,11 +4421,11 @@ def add_card_to_shared_deck(share_id):
     definition = (data.get('ans') or '').strip()
     image_id = data.get('image') or None
     if not term:
-        return jsonify({"status": 400, "error": "A term is required"}), 400
+        return _json_response({"status": 400, "error": "A term is required"}), 400
     if not definition and not image_id:
-        return jsonify({"status": 400, "error": "A definition or an image is required"}), 400
+        return _json_response({"status": 400, "error": "A definition or an image is required"}), 400
     if term not in cards and len(cards) >= MAX_SHARED_DECK_CARDS:
-        return jsonify({
+        return _json_response({
             "status": 400,
             "error": f"This deck has reached {MAX_SHARED_DECK_CARDS} cards.",
         }), 400
@@ -1945,12 +4435,10 @@ def add_card_to_shared_deck(share_id):
     card['definition'] = definition
     if image_id:
         card['image'] = image_id
-    editor = data.get('token')
-    _stamp_edited(card, editor) if existing else _stamp_created(card, editor)
-    cards[term] = card
+    _stamp_edited(card, token) if existing else _stamp_created(card, token)
 
-    _write_shared_card(share, collections, term, card)
-    return jsonify({"status": 200, "collection": share['collection_name']})
+    _write_shared_card(share, owner_doc, term, card, previous=existing)
+    return _json_response({"status": 200, "collection": share['collection_name']})
 
 
 @app.route('/api/shares/<share_id>/cards/edit', methods=['POST'])
@@ -1958,7 +4446,8 @@ def add_card_to_shared_deck(share_id):
 def edit_card_in_shared_deck(share_id):
     """Change a card in a deck shared for editing, including renaming its term."""
     data = request.get_json(silent=True) or {}
-    share, collections, cards, error = _open_shared_deck(share_id, data.get('token'))
+    token = _account_email(data.get('token'))
+    share, owner_doc, cards, error = _open_shared_deck(share_id, token)
     if error:
         return error
 
@@ -1966,28 +4455,25 @@ def edit_card_in_shared_deck(share_id):
     term = (data.get('word') or '').strip()
     definition = (data.get('ans') or '').strip()
     if not old_term or not term:
-        return jsonify({"status": 400, "error": "Missing required fields"}), 400
+        return _json_response({"status": 400, "error": "Missing required fields"}), 400
     if old_term not in cards:
-        return jsonify({"status": 404, "error": "That card is no longer in the deck"}), 404
+        return _json_response({"status": 404, "error": "That card is no longer in the deck"}), 404
     if not definition and not (data.get('image') or cards.get(old_term, {}).get('image')):
-        return jsonify({"status": 400, "error": "A definition or an image is required"}), 400
+        return _json_response({"status": 400, "error": "A definition or an image is required"}), 400
 
     card = _normalise_card(cards[old_term])
     card['definition'] = definition
     if 'image' in data:
         card['image'] = data.get('image') or None
-    _stamp_edited(card, data.get('token'))
+    _stamp_edited(card, token)
 
     # Renaming onto an existing card would silently swallow it.
     if term != old_term and term in cards:
-        return jsonify({"status": 400, "error": f'The deck already has a card called "{term}"'}), 400
+        return _json_response({"status": 400, "error": f'The deck already has a card called "{term}"'}), 400
 
-    if term != old_term:
-        del cards[old_term]
-    cards[term] = card
-
-    _write_shared_card(share, collections, term, card, replaced_term=old_term)
-    return jsonify({"status": 200, "collection": share['collection_name']})
+    _write_shared_card(share, owner_doc, term, card, replaced_term=old_term,
+                       previous=cards[old_term])
+    return _json_response({"status": 200, "collection": share['collection_name']})
 
 
 @app.route('/api/shares/<share_id>/import', methods=['POST'])
@@ -1995,34 +4481,34 @@ def edit_card_in_shared_deck(share_id):
 def import_share(share_id):
     """Copy a shared collection into the caller's account."""
     if flashcards_collection is None or shares_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data:
-        return jsonify({"status": 400, "error": "Missing token in request body"}), 400
+        return _json_response({"status": 400, "error": "Missing token in request body"}), 400
 
-    token = data['token']
-    share = shares_collection.find_one({'share_id': share_id})
+    token = _account_email(data['token'])
+    share = _find_share(share_id)
     if not share:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
 
-    owner_doc = flashcards_collection.find_one({'user_email': share['owner_email']})
-    source = migrate_user_to_collections(owner_doc).get(share['collection_name']) if owner_doc else None
+    owner_doc = _load_user(share['owner_email'])
+    source = _owned_deck(owner_doc, share['collection_name']) if owner_doc else None
     if source is None:
-        return jsonify({"status": 404, "error": "This link is no longer available"}), 404
+        return _json_response({"status": 404, "error": "This link is no longer available"}), 404
     if not source:
-        return jsonify({"status": 400, "error": "That collection is empty"}), 400
+        return _json_response({"status": 400, "error": "That collection is empty"}), 400
 
     # Importing your own link would copy a deck alongside itself, which is
     # never what opening it means -- people open their own share links to check
     # they work. Refused here rather than in a client, so no client can do it.
     if share['owner_email'] == token:
-        return jsonify({
+        return _json_response({
             "status": 400,
             "error": "This is your own deck. It is already in your collections.",
         }), 400
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user(token)
     collections = migrate_user_to_collections(user_doc) if user_doc else {}
 
     # Never overwrite what the recipient already has.
@@ -2043,35 +4529,28 @@ def import_share(share_id):
         copy['edited_at'] = card.get('edited_at')
         imported[term] = copy
 
-    collections[name] = imported
-
     # The cover is copied like any other picture, so the recipient's deck keeps
     # looking right even if the owner later deletes theirs.
-    meta = dict(_collection_meta(user_doc))
     copied_cover = _copy_image_for(_cover_of(owner_doc, share['collection_name']), token)
-    if copied_cover:
-        meta[name] = {**meta.get(name, {}), 'cover_image': copied_cover}
 
     if user_doc:
-        flashcards_collection.update_one(
-            {'user_email': token},
-            {'$set': {'collections': collections, 'collection_meta': meta,
-                      'updated_at': datetime.utcnow()}},
-        )
+        _write_collection(user_doc, name, imported)
+        if copied_cover:
+            _update_user(token, {'$set': {f'{_meta_field_path(name)}.cover_image': copied_cover}})
     else:
-        flashcards_collection.insert_one({
-            'user_email': token,
-            'collections': collections,
-            'collection_meta': meta,
-            'default_collection': name,
-            'created_at': datetime.utcnow(),
-        })
-
-    return Response(json.dumps({
+        meta = {name: {'cover_image': copied_cover}} if copied_cover else {}
+        if not _insert_user(token, name, {name: imported}, collection_meta=meta):
+            # Import into the account made meanwhile, which copies the
+            # pictures again.
+            for image_id in [*_card_image_ids(imported), copied_cover]:
+                _delete_image(image_id)
+            return import_share(share_id)
+
+    return _json_response({
         'status': 200,
         'collection': name,
         'imported': len(imported),
-    }), mimetype='application/json')
+    })
 
 
 # Quiz grading
@@ -2209,41 +4688,271 @@ def grade_quiz_answer():
     of adding a second one.
     """
     if flashcards_collection is None:
-        return jsonify({"status": 500, "error": "Database not connected"}), 500
+        return _json_response({"status": 500, "error": "Database not connected"}), 500
 
     data = request.get_json(silent=True)
     if not data or 'token' not in data or 'word' not in data or 'answer' not in data:
-        return jsonify({"status": 400, "error": "Missing required fields"}), 400
+        return _json_response({"status": 400, "error": "Missing required fields"}), 400
 
-    token = data['token']
+    token = _account_email(data['token'])
     word = data['word']
     collection_name = data.get('collection', 'Default')
 
-    user_doc = flashcards_collection.find_one({'user_email': token})
+    user_doc = _load_user_deck(token, collection_name)
     if not user_doc:
-        return jsonify({"status": 404, "error": "User not found"}), 404
+        return _json_response({"status": 404, "error": "User not found"}), 404
 
-    collections = migrate_user_to_collections(user_doc)
-    cards = collections.get(collection_name)
-    if cards is None:
-        return jsonify({"status": 404, "error": "Collection not found"}), 404
-    if word not in cards:
-        return jsonify({"status": 404, "error": "Word not found"}), 404
+    if collection_name not in migrate_user_to_collections(user_doc):
+        return _json_response({"status": 404, "error": "Collection not found"}), 404
+    stored = _owned_card(user_doc, collection_name, word)
+    if stored is None:
+        return _json_response({"status": 404, "error": "Word not found"}), 404
 
-    card = _normalise_card(cards[word])
+    card = _normalise_card(stored)
     if not card['definition'].strip():
         # Picture-only card: there is no text to compare against, so there is
         # nothing this endpoint can honestly say about the answer.
-        return jsonify({"status": 400, "error": "This card has no text to grade against"}), 400
+        return _json_response({"status": 400, "error": "This card has no text to grade against"}), 400
 
     grade, similarity = grade_answer(data['answer'], card['definition'])
 
-    return Response(json.dumps({
+    return _json_response({
         'status': 200,
         'grade': grade,
         'similarity': round(similarity, 4),
         'expected': card['definition'],
-    }), mimetype='application/json')
+    })
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+@cross_origin(headers=["Content-Type", "Authorization"])
+def cache_stats():
+    """How well the caches are doing: hits and misses of this process's own,
+    and of the shared cache with the latency of its recent calls. Each worker
+    answers for itself, so `pid` says which one this was."""
+    caches = {
+        name: {'size': len(cache), 'hits': cache.hits, 'misses': cache.misses,
+               'hit_rate': round(cache.hits / (cache.hits + cache.misses), 3)
+               if cache.hits + cache.misses else None}
+        for name, cache in _caches.items()
+    }
+    return _json_response({
+        "status": 200,
+        "pid": os.getpid(),
+        "caches": caches,
+        "shared": _shared_cache.stats() if _shared_cache is not None else None,
+    })
+
+
+# Indexes
+#
+# Every lookup in this file goes through one of these, and without them each
+# is a scan of the whole collection. They are created when the server starts
+# and by `flask --app main ensure-indexes`, which also reports indexes the
+# database has that nothing has used.
+#
+# (collection, keys, options). The collection is named rather than held so
+# this can be read before the database is connected.
+INDEXES = (
+    ('flashcards', [('user_email', 1)], {'unique': True}),
+    ('shares', [('share_id', 1)], {'unique': True}),
+    # The owner's own view: "is this deck of mine already shared?"
+    ('shares', [('owner_email', 1), ('collection_name', 1)], {}),
+    # Shares made since a worker last looked, for its filter of live links.
+    ('shares', [('created_at', 1)], {}),
+    # GridFS keeps the uploader in the file's metadata.
+    ('fs.files', [('metadata.user_email', 1)], {}),
+    ('cards', [('user_email', 1), ('collection', 1), ('term', 1)], {'unique': True}),
+    # The cards of a deck changed since a client last synced it.
+    ('cards', [('user_email', 1), ('collection', 1), ('changed', 1)], {}),
+    # A deck's cards in the order they were added: read a page at a time, and
+    # streamed.
+    ('cards', [('user_email', 1), ('collection', 1), ('_id', 1)], {}),
+)
+
+
+def _index_name(keys):
+    # The name MongoDB gives an index by default.
+    return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+
+def _ensure_indexes(create=True):
+    """Check every index in INDEXES, creating the missing ones unless told not
+    to. Returns (collection, index name, outcome) for each."""
+    report = []
+    for collection_name, keys, options in INDEXES:
+        collection = db[collection_name]
+        name = _index_name(keys)
+        if name in collection.index_information():
+            report.append((collection_name, name, 'present'))
+        elif not create:
+            report.append((collection_name, name, 'missing'))
+        else:
+            try:
+                collection.create_index(keys, **options)
+                report.append((collection_name, name, 'created'))
+            except OperationFailure as error:
+                # Most likely duplicates that a unique index refuses. The rest
+                # are still worth creating; this one needs looking at.
+                report.append((collection_name, name, f'failed: {error}'))
+    return report
+
+
+def _unused_indexes():
+    """Indexes on the collections above that no query has used since the
+    server last restarted, as (collection, index name, since)."""
+    unused = []
+    for collection_name in dict.fromkeys(name for name, _, _ in INDEXES):
+        try:
+            stats = list(db[collection_name].aggregate([{'$indexStats': {}}]))
+        except OperationFailure:
+            # Needs the clusterMonitor role, which an app user may not have.
+            continue
+        for entry in stats:
+            if entry['name'] != '_id_' and not entry['accesses']['ops']:
+                unused.append((collection_name, entry['name'], entry['accesses']['since']))
+    return unused
+
+
+# Maintenance commands
+#
+# Run with `flask --app main <command>` against the same environment as the
+# server. Each is safe to run while the server is taking requests.
+
+
+@app.cli.command('ensure-indexes')
+@click.option('--check', is_flag=True, help='Only report; create nothing.')
+def ensure_indexes(check):
+    """Create the indexes the app relies on and report unused ones."""
+    if flashcards_collection is None:
+        raise click.ClickException('Database not connected')
+    for collection_name, name, outcome in _ensure_indexes(create=not check):
+        click.echo(f'{collection_name}.{name}: {outcome}')
+    for collection_name, name, since in _unused_indexes():
+        click.echo(f'{collection_name}.{name}: unused since {since}')
+
+
+def _current_shape_update(stored_doc):
+    """The write that brings a document, exactly as stored, fully up to date.
+
+    Does in one go what _load_user() and _current_deck() do piecemeal. Matches
+    only while the document is as it was read, so a request writing to the
+    account in the meantime wins and the account is left to the lazy path.
+    """
+    user_doc = dict(stored_doc)
+    if user_doc.get('escaped_keys'):
+        user_doc.update(_converted_maps(user_doc, _unescape_key))
+    collections, _ = _stored_decks(user_doc)
+    user_doc.pop('cards', None)
+    user_doc['collections'] = {
+        name: {term: _normalise_card(value) for term, value in cards.items()}
+        for name, cards in collections.items()
+    }
+
+    return UpdateOne(
+        {'_id': stored_doc['_id'],
+         'schema_version': stored_doc.get('schema_version'),
+         'escaped_keys': stored_doc.get('escaped_keys'),
+         'updated_at': stored_doc.get('updated_at'),
+         'card_store': {'$exists': False}},
+        {'$set': {**_converted_maps(user_doc, _escape_key),
+                  'default_collection': user_doc.get('default_collection', 'Default'),
+                  'escaped_keys': True,
+                  'schema_version': SCHEMA_VERSION},
+         '$unset': {'cards': '', 'normalised_decks': ''},
+         '$inc': {'revision': 1}},
+    )
+
+
+@app.cli.command('migrate-documents')
+@click.option('--batch-size', default=200, show_default=True,
+              help='Documents read and written per round trip.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of an interrupted run.')
+def migrate_documents(batch_size, restart):
+    """Bring every user document to the current shape ahead of its next request.
+
+    Legacy 'cards' maps, sentinel-string cards and unescaped names are
+    otherwise converted by whichever request reads the account first. Resumes
+    where an interrupted run stopped.
+    """
+    if flashcards_collection is None or checkpoints_collection is None:
+        raise click.ClickException('Database not connected')
+
+    checkpoint_id = 'migrate-documents'
+    query = {'schema_version': {'$ne': SCHEMA_VERSION}, 'card_store': {'$exists': False}}
+    checkpoint = None if restart else checkpoints_collection.find_one({'_id': checkpoint_id})
+    if checkpoint:
+        query['_id'] = {'$gt': checkpoint['last_id']}
+        click.echo(f"Resuming after {checkpoint['last_id']}.")
+
+    cursor = flashcards_collection.find(query).sort('_id', 1).batch_size(batch_size)
+    started = time.monotonic()
+    seen = written = cards = 0
+    batch = []
+
+    def flush():
+        nonlocal written
+        result = flashcards_collection.bulk_write([_current_shape_update(doc) for doc in batch],
+                                                  ordered=False)
+        written += result.modified_count
+        for doc in batch:
+            _forget_user(doc['user_email'])
+        # Recorded only once the batch is written, so a run killed mid-batch
+        # redoes it rather than skipping it.
+        checkpoints_collection.update_one(
+            {'_id': checkpoint_id},
+            {'$set': {'last_id': batch[-1]['_id'], 'updated_at': datetime.utcnow()}},
+            upsert=True,
+        )
+        elapsed = max(time.monotonic() - started, 1e-9)
+        click.echo(f'{seen} documents, {cards} cards read; {written} rewritten '
+                   f'({seen / elapsed:.0f} documents/s, {cards / elapsed:.0f} cards/s)')
+        batch.clear()
+
+    for doc in cursor:
+        batch.append(doc)
+        seen += 1
+        cards += sum(len(deck) for deck in _stored_decks(doc)[0].values())
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    checkpoints_collection.delete_one({'_id': checkpoint_id})
+    # Anything not rewritten changed while it was being read; the request path
+    # still handles it, and a later run picks it up.
+    click.echo(f'Done: {written} of {seen} documents rewritten in '
+               f'{time.monotonic() - started:.1f}s.')
+
+
+@app.cli.command('migrate-card-store')
+@click.option('--email', default=None, help='Move only this account.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Cards written to the cards collection per insert.')
+def migrate_card_store(email, batch_size):
+    """Move accounts' cards out of their user documents into the cards collection."""
+    if flashcards_collection is None or cards_collection is None:
+        raise click.ClickException('Database not connected')
+    _ensure_indexes()
+
+    query = {'card_store': {'$exists': False}}
+    if email:
+        query['user_email'] = email
+    emails = [doc['user_email'] for doc in flashcards_collection.find(query, {'user_email': 1})]
+
+    accounts = cards = 0
+    busy = []
+    for account in emails:
+        moved = _move_cards_to_collection(account, batch_size)
+        if moved is None:
+            busy.append(account)
+            continue
+        accounts += 1
+        cards += moved
+    click.echo(f'Moved {cards} cards from {accounts} accounts.')
+    for account in busy:
+        # Written to by every attempt; running the command again picks it up.
+        click.echo(f'Skipped {account}: it kept changing while being moved.', err=True)
 
 
 @app.errorhandler(Exception)
@@ -2254,7 +4963,7 @@ def handle_unexpected_error(error):
         return error
 
     app.logger.error(f"An unexpected error occurred: {error}", exc_info=True)
-    response = jsonify({"status": 500, "error": "An unexpected error occurred."})
+    response = _json_response({"status": 500, "error": "An unexpected error occurred."})
     response.status_code = 500
     return response
 
@@ -2266,4 +4975,9 @@ if __name__ == '__main__':
     # Debug mode exposes the Werkzeug console; opt in explicitly for local work
     # rather than shipping it on by default.
     debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
+    _start_jwks_refresher()
+    if flashcards_collection is not None:
+        for collection_name, name, outcome in _ensure_indexes():
+            if outcome != 'present':
+                print(f"Index {collection_name}.{name}: {outcome}")
     app.run(debug=debug, host='0.0.0.0', port=port)